@@ -0,0 +1,40 @@
+from src.utils import *
+from src.train import *
+from src.data_generator import *
+import os, time
+from fire import Fire
+
+def benchmark_tfr(my_config, cycle_lengths=(4, 8, 16), n_batches=200, epochs=2):
+    """
+    Compare the training throughput (samples/s) of the TFR reader through __getitem__ with the
+    interleaved reader feeding tf.data directly, for several cycle lengths.
+    """
+    args = load_args(my_config)
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(args['gpu'])
+    assert args['train_tfr_files'] is not None, 'Set train_tfr_files'
+
+    def run(get_batches):
+        # The first epoch fills the buffers and is not timed
+        results = []
+        for e in range(epochs + 1):
+            t, n = time.time(), 0
+            for X, y in get_batches():
+                n += len(X)
+            if e > 0: results.append(n / (time.time() - t))
+        return np.mean(results)
+
+    args['tfr_interleave'] = None
+    dg_train = load_data(**args)[0]
+    def getitem():
+        dg_train._setup_tfrecord_ds()
+        for i in range(min(n_batches, len(dg_train) - 1)): yield dg_train[i]
+    print(f'__getitem__: {run(getitem):.1f} samples/s')
+
+    for cycle_length in cycle_lengths:
+        args['tfr_interleave'] = cycle_length
+        dg_train = load_data(**args)[0]
+        batches = lambda: dg_train.tfr_dataset.take(min(n_batches, len(dg_train) - 1))
+        print(f'interleave {cycle_length}: {run(batches):.1f} samples/s')
+
+if __name__ == '__main__':
+    Fire(benchmark_tfr)
@@ -5,7 +5,8 @@ from configargparse import ArgParser
 import ast, os
 from fire import Fire
 
-def convert_to_tfr(my_config, savedir='/data/stephan/WeatherBench/TFR', steps_per_file=250):
+def convert_to_tfr(my_config, savedir='/data/stephan/WeatherBench/TFR', steps_per_file=250, num_workers=1,
+                   time_records=False, raw_dtype=None, compression=None):
     args = load_args(my_config)
     os.environ["CUDA_VISIBLE_DEVICES"] = str(args['gpu'])
 
@@ -19,9 +20,12 @@ def convert_to_tfr(my_config, savedir='/data/stephan/WeatherBench/TFR', steps_pe
     os.makedirs(savedir + '/test', exist_ok=True)
 
     print('Save TFR files')
-    dg_train.to_tfr(savedir + '/train', steps_per_file)
-    dg_valid.to_tfr(savedir + '/valid', steps_per_file)
-    dg_test.to_tfr(savedir + '/test', steps_per_file)
+    for dg, split in zip([dg_train, dg_valid, dg_test], ['train', 'valid', 'test']):
+        if time_records:
+            dg.to_time_records(f'{savedir}/{split}', steps_per_file, num_workers)
+        else:
+            dg.to_tfr(f'{savedir}/{split}', steps_per_file, num_workers, raw_dtype=raw_dtype,
+                      compression=compression)
 
     print('Save norm files')
     dg_train.mean.to_netcdf(f'{savedir}/mean.nc')
@@ -0,0 +1,34 @@
+from src.utils import *
+from src.train import *
+from src.data_generator import *
+import os
+from fire import Fire
+
+def convert_to_zarr(my_config, savedir='/data/stephan/WeatherBench/zarr', time_chunk=1):
+    """
+    Write the variables in var_dict to one Zarr store, stacked to (time, lat, lon, level) with
+    level_names, chunked by time_chunk time steps with all lats, lons and levels in one chunk,
+    with consolidated metadata. The constants are stored once, as (lat, lon, const_level) with
+    const_names, and open_dataset broadcasts them along time. Use it with --zarr_store.
+    """
+    args = load_args(my_config)
+    if args['cmip']: args['cmip_dir'] = args['cmip_dir'][0]
+
+    print('Open data')
+    ds, _ = open_dataset(args['var_dict'], args['datadir'], args['cmip'], args['cmip_dir'])
+    var_dict = dict(args['var_dict'])
+    constants = var_dict.pop('constants', None)
+    data = stack_levels(ds, var_dict).astype('float32')
+    data = data.chunk({'time': time_chunk, 'lat': -1, 'lon': -1, 'level': -1})
+    store = data.to_dataset(name='data')
+    if constants:
+        const = stack_levels(ds.isel(time=[0]), {'constants': constants}).isel(time=0, drop=True)
+        const = const.rename({'level': 'const_level', 'level_names': 'const_names'})
+        store['constants'] = const.astype('float32').chunk(-1)
+
+    savedir = f"{savedir}/{args['exp_id']}.zarr"
+    print(f'Save {dict(data.sizes)} and {constants} to {savedir}')
+    store.to_zarr(savedir, mode='w', consolidated=True)
+
+if __name__ == '__main__':
+    Fire(convert_to_zarr)
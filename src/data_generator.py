@@ -1,17 +1,28 @@
 import re
+import os
+import json
+import hashlib
+import mmap
+import multiprocessing
 import numpy as np
 import xarray as xr
 import tensorflow as tf
 import tensorflow.keras as keras
+from tensorflow.core.framework.tensor_pb2 import TensorProto
 import datetime
 from src.utils import *
 import pandas as pd
 import pdb
 import logging
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 
 def _tensor_feature(value):
-    value = tf.io.serialize_tensor(value).numpy()
+    # Same bytes as tf.io.serialize_tensor but without running an op, so it also works in forked workers
+    value = tf.make_tensor_proto(value).SerializeToString()
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 def _bytes_feature(value):
@@ -35,12 +46,514 @@ features = {
 def _parse(example_proto):
     return tf.io.parse_single_example(example_proto, features)
 
+def serialize_raw_example(X, y, dtype):
+    'Fixed-shape encoding without tensor protos. The shapes and dtype are stored in manifest.json.'
+    feature = {
+        'X': _bytes_feature(X.astype(dtype).tobytes()),
+        'y': _bytes_feature(y.astype(dtype).tobytes())
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+time_record_features = {
+    'x': tf.io.FixedLenFeature([], tf.string),
+    'time': tf.io.FixedLenFeature([], tf.int64)
+}
+
+def serialize_time_record(x, time):
+    feature = tf.train.Features(feature={
+        'x': _tensor_feature(x),
+        'time': tf.train.Feature(int64_list=tf.train.Int64List(value=[time]))
+    })
+    return tf.train.Example(features=feature).SerializeToString()
+
+def decode_time_record(example_proto):
+    return tf.io.parse_tensor(tf.io.parse_single_example(example_proto, time_record_features)['x'], np.float32)
+
 def decode(example_proto):
     dic = _parse(example_proto)
     X = tf.io.parse_tensor(dic['X'], np.float32)
     y = tf.io.parse_tensor(dic['y'], np.float32)
     return X, y
 
+def _as_slice(idxs):
+    """Return a slice if idxs are contiguous and increasing. Slices index numpy without copying."""
+    idxs = list(idxs)
+    if len(idxs) > 0 and idxs == list(range(idxs[0], idxs[-1] + 1)):
+        return slice(idxs[0], idxs[-1] + 1)
+    return idxs
+
+def gather(src, time_idxs, level_idxs=None, out=None):
+    """
+    Gather time steps (and optionally levels) from a (time, lat, lon, level) array.
+    Numpy-backed data is gathered with np.take directly into out. Lazy data goes through isel.
+    time_idxs can have any shape, e.g. (batch, n_steps), which replaces the time axis.
+    Returns out, which is allocated as float32 if not given.
+    """
+    time_idxs = np.asarray(time_idxs)
+    if isinstance(src, (BlockStream, RollingMean)):
+        return src.take(time_idxs, level_idxs, out)
+    if isinstance(src, xr.DataArray):
+        if not isinstance(src.data, np.ndarray):
+            if level_idxs is not None: src = src.isel(level=level_idxs)
+            arr = src.isel(time=time_idxs.ravel()).values.reshape(time_idxs.shape + src.shape[1:])
+            if out is None: return arr.astype('float32')
+            out[...] = arr
+            return out
+        src = src.data
+    if level_idxs is not None:
+        level_idxs = _as_slice(level_idxs)
+        if type(level_idxs) is not slice:
+            arr = np.take(src, time_idxs, axis=0)[..., level_idxs]
+            if out is None: return arr.astype('float32')
+            out[...] = arr
+            return out
+        src = src[..., level_idxs]
+    if out is None:
+        out = np.empty(time_idxs.shape + src.shape[1:], dtype='float32')
+    # Indices are checked by construction. 'clip' avoids the buffered copy of mode='raise'.
+    if src.dtype != out.dtype:
+        # Half precision storage: only the gathered time steps are upcast
+        out[...] = np.take(src, time_idxs, axis=0, mode='clip')
+        return out
+    return np.take(src, time_idxs, axis=0, out=out, mode='clip')
+
+def shared_empty(shape, dtype='float32'):
+    'Empty array in an anonymous shared mapping, which forked processes use without copies'
+    n = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(n * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buf, dtype, n).reshape(shape)
+
+def load_array(data, dtype='float32', mean=None, std=None, chunk_bytes=64e6, num_workers=1, shared=False):
+    """
+    Load a lazy (time, ..., level) DataArray into a C-contiguous array of dtype. Each variable (dask chunk
+    along level) is read in pieces of about chunk_bytes (as float32) along time, in num_workers threads,
+    and written into its slot of the output, so the stacked array is never built. The transient memory
+    is about 2 * num_workers * chunk_bytes. If mean and std are given, each piece is normalized in float32
+    before it is cast to dtype. If shared, the output is a shared_empty array.
+    """
+    out = shared_empty(data.shape, dtype) if shared else np.empty(data.shape, dtype=dtype)
+    level_chunks = data.chunks[-1] if data.chunks is not None else (data.shape[-1],)
+    bounds = np.cumsum((0,) + level_chunks)
+    step_size = int(np.prod(data.shape[1:-1])) * 4  # float32 bytes of a time step of one level
+    # Parallel over pieces instead of inside dask for each piece
+    scheduler = 'synchronous' if num_workers > 1 else None
+    def load(piece):
+        start, stop, l = piece
+        chunk = data.isel(time=slice(start, stop), level=l).astype('float32')
+        chunk = chunk.compute(scheduler=scheduler).values
+        if mean is not None:
+            chunk = (chunk - mean[l]) / std[l]
+        out[start:stop, ..., l] = chunk
+    pieces = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        n_time = max(1, int(chunk_bytes // (step_size * (b - a))))
+        pieces += [(start, start + n_time, slice(a, b)) for start in range(0, len(data.time), n_time)]
+    with ThreadPoolExecutor(num_workers) as pool:
+        list(pool.map(load, pieces))
+    return out
+
+def compute_mean_std(data, chunk_bytes=64e6):
+    """
+    Per-level mean and std over (time, lat, lon) of a lazy (time, lat, lon, level) DataArray in a
+    single pass. Each variable (dask chunk along level) is read in pieces of about chunk_bytes (as
+    float64) along time, and the statistics of the pieces are merged with Chan's parallel update.
+    The pieces are reduced in place, so the memory stays about chunk_bytes. NaNs are skipped.
+    """
+    level_chunks = data.chunks[-1] if data.chunks is not None else (data.shape[-1],)
+    bounds = np.cumsum((0,) + level_chunks)
+    step_size = int(np.prod(data.shape[1:-1])) * 8  # float64 bytes of a time step of one level
+    means, m2s, ns = [], [], []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        n_time = max(1, int(chunk_bytes // (step_size * (b - a))))
+        n, mean, m2 = 0, 0, 0
+        for start in range(0, len(data.time), n_time):
+            x = data.isel(time=slice(start, start + n_time), level=slice(a, b)).values.astype('float64')
+            x = x.reshape(-1, b - a)
+            nan = np.isnan(x)
+            has_nan = nan.any()
+            n_b = len(x) - nan.sum(0)
+            if has_nan: x[nan] = 0
+            mean_b = x.sum(0) / n_b
+            x -= mean_b
+            if has_nan: x[nan] = 0
+            m2_b = np.einsum('ij,ij->j', x, x)
+            n_tot = n + n_b
+            delta = mean_b - mean
+            mean = mean + delta * n_b / n_tot
+            m2 = m2 + m2_b + delta ** 2 * n * n_b / n_tot
+            n = n_tot
+        means.append(mean); m2s.append(m2); ns.append(n)
+    mean, m2, n = [np.concatenate(v) for v in (means, m2s, ns)]
+    coords = {'level': data.level, 'level_names': data.level_names}
+    return (xr.DataArray(mean, dims=['level'], coords=coords),
+            xr.DataArray(np.sqrt(m2 / n), dims=['level'], coords=coords))
+
+
+def stack_levels(ds, var_dict, tp_log=None):
+    """
+    Lazy (time, lat, lon, level) DataArray of the variables in var_dict with level_names. ds is a Dataset
+    or an already stacked DataArray, e.g. a store written by convert_to_zarr.
+    """
+    if isinstance(ds, xr.DataArray):
+        return _select_levels(ds, var_dict, tp_log)
+    data = []
+    level_names = []
+    generic_level = xr.DataArray([1], coords={'level': [1]}, dims=['level'])
+    for long_var, params in var_dict.items():
+        if long_var == 'constants':
+            for var in params:
+                data.append(ds[var].expand_dims(
+                    {'level': generic_level, 'time': ds.time}, (1, 0)
+                ))
+                level_names.append(var)
+        else:
+            var, levels = params
+            da = ds[var]
+            if tp_log and var == 'tp':
+                da = log_trans(da, tp_log)
+            try:
+                data.append(da.sel(level=levels))
+                level_names += [f'{var}_{level}' for level in levels]
+            except ValueError:
+                data.append(da.expand_dims({'level': generic_level}, 1))
+                level_names.append(var)
+
+    data = xr.concat(data, 'level').transpose('time', 'lat', 'lon', 'level')
+    data['level_names'] = xr.DataArray(
+        level_names, dims=['level'], coords={'level': data.level})
+    return data
+
+def _select_levels(data, var_dict, tp_log=None):
+    'Levels of var_dict from a stacked DataArray'
+    names = list(data.level_names.values)
+    idxs = []
+    for long_var, params in var_dict.items():
+        if long_var == 'constants':
+            idxs += [names.index(var) for var in params]
+        else:
+            var, levels = params
+            if levels is not None and f'{var}_{levels[0]}' in names:
+                idxs += [names.index(f'{var}_{level}') for level in levels]
+            else:
+                idxs.append(names.index(var))
+    data = data.isel(level=idxs)
+    if tp_log and 'tp' in names:
+        is_tp = data.level_names == 'tp'
+        data = xr.where(is_tp, log_trans(data, tp_log), data).transpose(*data.dims)
+    return data
+
+
+class QuantileSketch(object):
+    """
+    Mergeable one-pass quantile sketch with relative accuracy rel_acc (DDSketch, Masson et al. 2019).
+    Values are counted in logarithmic buckets, separately for positive and negative values.
+    Values with a magnitude below min_value count as zero.
+    """
+    def __init__(self, rel_acc=0.001, min_value=1e-9):
+        self.gamma = (1 + rel_acc) / (1 - rel_acc)
+        self.min_value = min_value
+        self.stores = {1: (np.zeros(0, 'int64'), np.zeros(0)), -1: (np.zeros(0, 'int64'), np.zeros(0))}
+        self.zeros = 0
+
+    @staticmethod
+    def _merge(store, keys, counts):
+        keys, inv = np.unique(np.concatenate([store[0], keys]), return_inverse=True)
+        return keys, np.bincount(inv, weights=np.concatenate([store[1], counts]))
+
+    def add(self, x):
+        x = np.asarray(x, dtype='float64').reshape(-1)
+        x = x[np.isfinite(x)]
+        small = np.abs(x) < self.min_value
+        self.zeros += small.sum()
+        x = x[~small]
+        for sign in [1, -1]:
+            keys = np.ceil(np.log(x[sign * x > 0] * sign) / np.log(self.gamma)).astype('int64')
+            keys, counts = np.unique(keys, return_counts=True)
+            self.stores[sign] = self._merge(self.stores[sign], keys, counts)
+        return self
+
+    def merge(self, other):
+        assert self.gamma == other.gamma, 'Sketches must have the same accuracy'
+        for sign in [1, -1]:
+            self.stores[sign] = self._merge(self.stores[sign], *other.stores[sign])
+        self.zeros += other.zeros
+        return self
+
+    def quantile(self, q):
+        (nk, nc), (pk, pc) = self.stores[-1], self.stores[1]
+        value = lambda k: 2 * self.gamma ** k / (self.gamma + 1)
+        values = np.concatenate([-value(nk[::-1]), [0], value(pk)])
+        cum = np.cumsum(np.concatenate([nc[::-1], [self.zeros], pc]))
+        rank = np.asarray(q) * (cum[-1] - 1)
+        return values[np.minimum(np.searchsorted(cum, rank, side='right'), len(values) - 1)]
+
+
+class CumSum(object):
+    """
+    Cumulative sum along time of a (time, lat, lon, level) array, so that sums over any time window are
+    the difference of two gathered prefix sums. Prefix sums are float32 within blocks of block_size time
+    steps and the sums up to each block are float64, so the error does not grow with the length of data.
+    The first time step is subtracted before summing to keep unnormalized data small.
+    """
+    def __init__(self, data, block_size=64):
+        self.block_size = block_size
+        self.shift = data[0].astype('float32')
+        self.local = np.empty((len(data) + 1,) + data.shape[1:], dtype='float32')
+        block_sums = []
+        for start in range(0, len(data) + 1, block_size):
+            stop = min(start + block_size, len(data) + 1)
+            block = data[start:start + block_size] - self.shift
+            self.local[start] = 0
+            np.cumsum(block[:stop - 1 - start], axis=0, out=self.local[start + 1:stop])
+            block_sums.append(block.sum(0, dtype='float64'))
+        self.offset = np.cumsum([np.zeros(data.shape[1:])] + block_sums[:-1], 0)
+
+
+class RollingMean(object):
+    'Mean over the window time steps up to and including each time step, computed from a CumSum'
+    def __init__(self, cumsum, window):
+        self.cumsum = cumsum
+        self.window = window
+
+    def take(self, time_idxs, level_idxs=None, out=None):
+        cs = self.cumsum
+        stop = np.asarray(time_idxs) + 1
+        start = stop - self.window
+        offset = cs.offset[stop // cs.block_size] - cs.offset[start // cs.block_size]
+        shift = cs.shift
+        if level_idxs is not None:
+            offset = offset[..., level_idxs]
+            shift = shift[..., level_idxs]
+        out = gather(cs.local, stop, level_idxs, out=out)
+        out -= gather(cs.local, start, level_idxs)
+        out += offset
+        out /= self.window
+        out += shift
+        return out
+
+
+class SharedData(object):
+    """
+    One loaded copy of the non-constant levels for several DataGenerators on the same ds,
+    e.g. train/valid/test. times are the time steps of all generators. The first generator that
+    takes its data loads (and normalizes) them all, the others get views of that array.
+    """
+    def __init__(self, ds, var_dict, times, tp_log=None):
+        self.ds = ds
+        self.var_dict = var_dict
+        self.time = np.unique(np.concatenate(times))
+        self.tp_log = tp_log
+        self.data_np = None
+        self.lock = threading.Lock()
+
+    def take(self, dg):
+        'data_np of dg. A view if its time steps are evenly spaced in the shared array, else a copy.'
+        with self.lock:
+            if self.data_np is None:
+                self._load(dg)
+        assert np.allclose(self.mean_np, dg.mean_np) and np.allclose(self.std_np, dg.std_np) and \
+            self.normalized == (dg.normalize and not dg.normalize_batches) and \
+            self.data_np.dtype == dg.storage_dtype, 'Inconsistent normalization or storage_dtype'
+        idxs = pd.Index(self.time).get_indexer(dg.data.time.values)
+        assert (idxs >= 0).all(), 'Time steps missing from SharedData'
+        step = idxs[1] - idxs[0] if len(idxs) > 1 else 1
+        if step > 0 and (np.diff(idxs) == step).all():
+            return self.data_np[idxs[0]:idxs[-1] + 1:step]
+        return self.data_np[idxs]
+
+    def _load(self, dg):
+        data = stack_levels(self.ds.sel(time=self.time), self.var_dict, self.tp_log)
+        assert list(data.level_names.values) == list(dg.data.level_names.values)
+        self.mean_np, self.std_np = dg.mean_np, dg.std_np
+        self.normalized = dg.normalize and not dg.normalize_batches
+        self.data_np = load_array(
+            data.isel(level=dg.not_const_idxs), dg.storage_dtype,
+            mean=self.mean_np if self.normalized else None, std=self.std_np, num_workers=dg.load_workers,
+            shared=dg.prefetch_processes
+        )
+
+
+class BlockStream(object):
+    """
+    Out-of-core access to a lazy (time, lat, lon, level) DataArray. Data is read from disk in
+    time-contiguous blocks. Block b holds the samples in [b * block_size, (b + 1) * block_size)
+    plus halo_before/halo_after time steps for their inputs and targets. The max_blocks most
+    recently used blocks are kept in RAM.
+    """
+    def __init__(self, data, block_size, max_blocks, halo_before=0, halo_after=0):
+        self.data = data
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.halo_before = halo_before
+        self.halo_after = halo_after
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def block(self, b):
+        'Return (first time index, array) of block b, reading it from disk if necessary'
+        with self.lock:
+            if b in self.blocks:
+                self.blocks.move_to_end(b)
+                return self.blocks[b]
+        start = max(b * self.block_size - self.halo_before, 0)
+        stop = (b + 1) * self.block_size + self.halo_after
+        arr = np.ascontiguousarray(self.data.isel(time=slice(start, stop)).astype('float32').values)
+        with self.lock:
+            self.blocks[b] = (start, arr)
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return start, arr
+
+    def load(self, sample_idxs):
+        'Make sure that the blocks of these samples are in RAM'
+        for b in np.unique(np.asarray(sample_idxs) // self.block_size):
+            self.block(b)
+
+    def take(self, time_idxs, level_idxs=None, out=None):
+        time_idxs = np.asarray(time_idxs)
+        left = np.ones(time_idxs.shape, dtype=bool)
+        with self.lock:
+            blocks = list(self.blocks.values())
+        for start, arr in blocks:
+            m = left & (time_idxs >= start) & (time_idxs < start + len(arr))
+            if m.any():
+                out = self._fill(out, m, gather(arr, time_idxs[m] - start, level_idxs))
+                left &= ~m
+        # Time steps not in RAM are read with the block whose samples contain them
+        for b in np.unique(time_idxs[left] // self.block_size):
+            start, arr = self.block(b)
+            m = left & (time_idxs // self.block_size == b)
+            out = self._fill(out, m, gather(arr, time_idxs[m] - start, level_idxs))
+        return out
+
+    @staticmethod
+    def _fill(out, m, arr):
+        if out is None:
+            out = np.empty(m.shape + arr.shape[1:], dtype='float32')
+        out[m] = arr
+        return out
+
+
+class BatchPrefetcher(object):
+    """
+    Assembles upcoming batches of a DataGenerator in a pool of worker threads.
+    Batches are keyed by their index, so the order is the same as without prefetching.
+    At most queue_size batches are scheduled ahead of the last requested one, only while the batches are
+    requested in order. Out of order (e.g. fit(shuffle=True)), each batch is assembled when requested.
+    Note that random lead times (cont_time) are drawn in the worker threads.
+    """
+    def __init__(self, dg, num_workers, queue_size):
+        self.dg = dg
+        self.queue_size = queue_size
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.last = -1
+
+    def _submit(self, i):
+        # Capture the indices now so that on_epoch_end cannot change a scheduled batch
+        idxs = self.dg.idxs[i * self.dg.batch_size:(i + 1) * self.dg.batch_size]
+        return self.pool.submit(self.dg._get_item, i, idxs)
+
+    def __getitem__(self, i):
+        with self.lock:
+            sequential = i in (0, self.last + 1)
+            self.last = i
+            ahead = range(i + 1, min(i + 1 + self.queue_size, len(self.dg)) if sequential else i + 1)
+            for j in list(self.futures):
+                if j != i and j not in ahead: self._cancel(self.futures.pop(j))
+            future = self.futures.pop(i, None) or self._submit(i)
+            for j in ahead:
+                if j not in self.futures: self.futures[j] = self._submit(j)
+        return self._result(future)
+
+    def _cancel(self, future):
+        future.cancel()
+
+    def _result(self, future):
+        return future.result()
+
+    def reset(self):
+        with self.lock:
+            for future in self.futures.values(): self._cancel(future)
+            self.futures = {}
+            self.last = -1
+
+
+_prefetch_dg = None  # DataGenerator and batch slots of a ProcessBatchPrefetcher, inherited by forked workers
+
+def _prefetch_batch(i, idxs, slot):
+    dg, X_slots, y_slots = _prefetch_dg
+    X, y = dg._get_item(i, idxs)
+    if X_slots is None: return X, y
+    X_slots[slot, :len(X)] = X
+    y_slots[slot, :len(y)] = y
+    return len(X)
+
+
+class ProcessBatchPrefetcher(BatchPrefetcher):
+    """
+    BatchPrefetcher with forked worker processes, which are not limited by the GIL. The loaded data should
+    be a shared_empty array (prefetch_processes), so that the workers use it without copies. Batches are
+    written to shared slots instead of being pickled. The workers see the generator as it was when they
+    were started, so they are restarted after each epoch. Random lead times are drawn in the workers.
+    """
+    def __init__(self, dg, num_workers, queue_size):
+        self.dg = dg
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.last = -1
+        self.pool = None
+
+    def _start(self):
+        global _prefetch_dg
+        assert self.dg.data_np is not None, 'Worker processes require loaded data'
+        X, y = self.dg._get_item(None, self.dg.idxs[:self.dg.batch_size])
+        # Running tasks of cancelled batches keep their slot until they are done
+        n_slots = self.queue_size + self.num_workers + 1
+        self.X_slots = self.y_slots = None
+        if isinstance(X, np.ndarray) and isinstance(y, np.ndarray):  # Otherwise (multi_dt) batches are pickled
+            self.X_slots = shared_empty((n_slots,) + X.shape, X.dtype)
+            self.y_slots = shared_empty((n_slots,) + y.shape, y.dtype)
+        # A queue, so that a batch requested out of order waits for a cancelled task to free its slot
+        self.free = queue.SimpleQueue()
+        for slot in range(n_slots): self.free.put(slot)
+        _prefetch_dg = (self.dg, self.X_slots, self.y_slots)
+        self.pool = ProcessPoolExecutor(
+            self.num_workers, multiprocessing.get_context('fork'), initializer=np.random.seed)
+
+    def _submit(self, i):
+        if self.pool is None: self._start()
+        idxs = self.dg.idxs[i * self.dg.batch_size:(i + 1) * self.dg.batch_size]
+        slot = self.free.get()
+        future = self.pool.submit(_prefetch_batch, i, idxs, slot)
+        future.slot = slot
+        return future
+
+    def _cancel(self, future):
+        free = self.free
+        if future.cancel():
+            free.put(future.slot)
+        else:
+            future.add_done_callback(lambda f: free.put(f.slot))
+
+    def _result(self, future):
+        try:
+            if self.X_slots is None: return future.result()
+            n = future.result()
+            return self.X_slots[future.slot, :n].copy(), self.y_slots[future.slot, :n].copy()
+        finally:
+            self.free.put(future.slot)
+
+    def reset(self):
+        super().reset()
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
 
 class DataGenerator(keras.utils.Sequence):
     def __init__(self, ds, var_dict, lead_time, batch_size=32, shuffle=True, load=True,
@@ -51,7 +564,12 @@ class DataGenerator(keras.utils.Sequence):
                  cont_dt=1, tfr_prefetch=None, tfr_repeat=True, y_roll=None, X_roll=None,
                  discard_first=None, tp_log=None, tfr_out=False, tfr_out_idxs=None,
                  old_const=False, is_categorical=False, num_bins=50, bin_min=-5, bin_max=5,
-                 predict_difference=False, quantile_bins=None):
+                 predict_difference=False, quantile_bins=None, bins=None, normalize_batches=False,
+                 prefetch_workers=0, prefetch_size=4, tf_data=False, stream_block_size=None,
+                 stream_buffer_blocks=8, norm_cache_dir=None, data_fingerprint=None, shared_data=None,
+                 sparse_categorical=False, storage_dtype='float32', tfr_time_records=False,
+                 tfr_interleave=None, load_workers=None, prefetch_processes=False,
+                 num_shards=1, shard_index=0, shard_seed=0):
         """
         Data generator for WeatherBench data.
         Template from https://stanford.edu/~shervine/blog/keras-how-to-generate-data-on-the-fly
@@ -68,6 +586,44 @@ class DataGenerator(keras.utils.Sequence):
             norm_subsample: Same for normalization. This is AFTER data_subsample!
             nt_in: How many time steps for input. AFTER data_subsample!
             dt_in: Interval of input time steps. AFTER data_subsample!
+            normalize_batches: If True (and load), keep only the raw data in RAM and normalize
+                each batch on the fly. Otherwise the loaded data is normalized in place.
+            prefetch_workers: If > 0, assemble the next prefetch_size batches in this many threads
+                while the current batch is used.
+            tf_data: If True (and load), build a tf.data pipeline (tfr_dataset) that gathers the
+                batches from the loaded data inside the graph.
+            stream_block_size: If given, the data is not loaded but streamed from disk in
+                time-contiguous blocks of this many time steps (AFTER data_subsample).
+            stream_buffer_blocks: Number of blocks that are shuffled together when streaming.
+                Block order is shuffled each epoch.
+            norm_cache_dir: If given, computed mean and std are cached in this directory. The key is
+                made from data_fingerprint, var_dict, the time range, subsampling and tp_log.
+            data_fingerprint: Fingerprint of the data files, e.g. from files_fingerprint.
+                Defaults to the sources of the variables in ds.
+            shared_data: SharedData that holds the loaded data of this and other generators.
+                If given (and load), data_np is a view of it.
+            sparse_categorical: If True (and is_categorical), y holds int32 bin indices instead of
+                one-hot vectors over num_bins.
+            bins: Bin edges for is_categorical, e.g. those of the training generator. If None, they are
+                computed from the targets (quantile_bins) or spaced evenly between bin_min and bin_max.
+            storage_dtype: dtype of the loaded, normalized data_np, e.g. float16 or bfloat16 to halve the
+                memory. Batches are upcast to float32.
+            tfr_time_records: If True, tfrecord_files are shards written by to_time_records. Samples are
+                assembled from the stored time steps when reading.
+            tfr_interleave: If given, decode in parallel and autotune the prefetching. If shuffle, read this
+                many files in parallel, in shuffled order, and the order of the samples is not
+                deterministic. Otherwise the files are read one after the other. With tfr_time_records, the number of shards whose samples are mixed.
+            load_workers: Threads reading the variables when loading the data. Default: number of CPUs, at most 8
+            prefetch_processes: If True, the prefetch_workers are forked processes and the data is
+                loaded into shared memory.
+            num_shards: If > 1, this generator only yields shard shard_index of the samples, for data-parallel
+                training with one generator per worker. The samples are permuted with the same seeded
+                permutation on all workers each epoch (if shuffle) and split into equal shares.
+            shard_seed: Seed of these permutations, which must be the same on all workers
+
+        If load, the non-constant levels are kept as one C-contiguous float32 array (data_np) of shape
+        (time, lat, lon, level). Constants are stored once as (lat, lon, n_const) in const_np and are
+        broadcast into each batch. self.data stays lazy and is only used for metadata.
         """
         if verbose: print('DG start', datetime.datetime.now().time())
         self.ds = ds
@@ -96,41 +652,39 @@ class DataGenerator(keras.utils.Sequence):
         self.tfr_out_idxs = tfr_out_idxs
         self.old_const = old_const
         self.is_categorical = is_categorical
+        self.sparse_categorical = sparse_categorical
         self.num_bins = num_bins
         self.bin_min = bin_min
         self.bin_max = bin_max
         self.predict_difference = predict_difference
+        self.tfr_time_records = tfr_time_records
+        self.tfr_interleave = tfr_interleave
+        self.load_workers = load_workers or min(os.cpu_count(), 8)
         if self.predict_difference:
-            assert self.tfrecord_files is None, 'difference does not work for tfr'
+            assert self.tfrecord_files is None or tfr_time_records, 'difference does not work for tfr'
         self.quantile_bins = quantile_bins
-
-        data = []
-        level_names = []
-        generic_level = xr.DataArray([1], coords={'level': [1]}, dims=['level'])
-        for long_var, params in var_dict.items():
-            if long_var == 'constants':
-                for var in params:
-                    data.append(ds[var].expand_dims(
-                        {'level': generic_level, 'time': ds.time}, (1, 0)
-                    ))
-                    level_names.append(var)
-            else:
-                var, levels = params
-                da = ds[var]
-                if tp_log and var == 'tp':
-                    da = log_trans(da, tp_log)
-                try:
-                    data.append(da.sel(level=levels))
-                    level_names += [f'{var}_{level}' for level in levels]
-                except ValueError:
-                    data.append(da.expand_dims({'level': generic_level}, 1))
-                    level_names.append(var)
-
-        self.data = xr.concat(data, 'level').transpose('time', 'lat', 'lon', 'level')
+        self.stream_block_size = stream_block_size
+        self.stream_buffer_blocks = stream_buffer_blocks
+        load = load and stream_block_size is None
+        self.normalize_batches = normalize_batches and normalize and load
+        self.storage_dtype = np.dtype(tf.as_dtype(storage_dtype).as_numpy_dtype)
+        if self.storage_dtype != np.float32:
+            assert normalize and not self.normalize_batches, 'Half precision storage requires normalized data'
+        self.tf_data = tf_data
+        self.prefetch_processes = prefetch_processes
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.shard_seed = shard_seed
+        self.epoch = -1
+        self.prefetcher = None
+        if prefetch_workers > 0 and prefetch_processes:
+            self.prefetcher = ProcessBatchPrefetcher(self, prefetch_workers, prefetch_size)
+        elif prefetch_workers > 0:
+            self.prefetcher = BatchPrefetcher(self, prefetch_workers, prefetch_size)
+
+        self.data = stack_levels(ds, var_dict, tp_log)
         if discard_first is not None:
             self.data = self.data.isel(time=slice(discard_first, None))
-        self.data['level_names'] = xr.DataArray(
-            level_names, dims=['level'], coords={'level': self.data.level})
         if output_vars is None:
             self.output_idxs = range(len(self.data.level))
         else:
@@ -138,6 +692,11 @@ class DataGenerator(keras.utils.Sequence):
                                 if any([bool(re.match(o, l)) for o in output_vars])]
         self.const_idxs = [i for i, l in enumerate(self.data.level_names) if l in var_dict['constants']]
         self.not_const_idxs = [i for i, l in enumerate(self.data.level_names) if l not in var_dict['constants']]
+        # Channel of each level in data_np or const_np; -1 if the level is stored in the other one.
+        self.var_chan = np.full(len(self.data.level), -1)
+        self.var_chan[self.not_const_idxs] = np.arange(len(self.not_const_idxs))
+        self.const_chan = np.full(len(self.data.level), -1)
+        self.const_chan[self.const_idxs] = np.arange(len(self.const_idxs))
 
         # Subsample
         self.data = self.data.isel(time=slice(0, None, data_subsample))
@@ -153,36 +712,57 @@ class DataGenerator(keras.utils.Sequence):
 
         # Normalize
         if verbose: print('DG normalize', datetime.datetime.now().time())
-        if mean is not None:
-            self.mean = mean
-        else:
-            self.mean = self.data.isel(time=slice(0, None, norm_subsample)).mean(
-                ('time', 'lat', 'lon')).compute()
-            if 'tp' in self.data.level_names:  # set tp mean to zero but not if ext
-                tp_idx = list(self.data.level_names).index('tp')
-                self.mean.values[tp_idx] = 0
-
-        if std is not None:
-            self.std = std
-        else:
-            self.std = self.data.isel(time=slice(0, None, norm_subsample)).std(
-                ('time', 'lat', 'lon')).compute()
+        if data_fingerprint is None:
+            variables = ds.data_vars.values() if isinstance(ds, xr.Dataset) else [ds]
+            data_fingerprint = sorted(str(v.encoding.get('source')) for v in variables)
+        self.cache_id = (data_fingerprint, var_dict, str(self.data.time.values[0]),
+                         str(self.data.time.values[-1]), data_subsample, norm_subsample, tp_log)
+        if mean is None or std is None:
+            cache_key = hashlib.md5(repr(self.cache_id).encode()).hexdigest()
+            norm_mean, norm_std = self._norm_stats(norm_subsample, norm_cache_dir, cache_key)
+        self.mean = mean if mean is not None else norm_mean
+        self.std = std if std is not None else norm_std
 
         if tp_log is not None:
             self.mean.attrs['tp_log'] = tp_log
             self.std.attrs['tp_log'] = tp_log
+        # For the non-constant levels in data_np
+        self.mean_np = self.mean.values[self.not_const_idxs].astype('float32')
+        self.std_np = self.std.values[self.not_const_idxs].astype('float32')
         if normalize:
             self.data = (self.data - self.mean) / self.std
+        self.const_np = np.ascontiguousarray(
+            self.data.isel(time=0, level=self.const_idxs).astype('float32').values)
 
         if verbose: print('DG load', datetime.datetime.now().time())
-        if load:
+        if load and shared_data is not None:
+            if verbose: print('Taking data from SharedData')
+            self.data_np = shared_data.take(self)
+        elif load:
             if verbose: print('Loading data into RAM')
-            self.data.load()
+            # Load and normalize chunk by chunk so that only one copy is held in RAM
+            self.data_np = load_array(
+                self.raw_data.isel(level=self.not_const_idxs), self.storage_dtype,
+                mean=self.mean_np if normalize and not self.normalize_batches else None, std=self.std_np,
+                num_workers=self.load_workers, shared=self.prefetch_processes
+            )
+        else:
+            self.data_np = None
         if verbose: print('DG done', datetime.datetime.now().time())
 
+        self.stream = None
+        if stream_block_size is not None:
+            assert self.X_roll is None and self.y_roll is None, 'Rolling does not work for streaming'
+            # Room for two buffers since batches can straddle the boundary between them
+            self.stream = BlockStream(
+                self.data.isel(level=self.not_const_idxs), stream_block_size, 2 * stream_buffer_blocks,
+                halo_before=self.nt_offset, halo_after=self.nt + 1
+            )
+
+        self.cumsum = None
         if self.X_roll is not None:
             self.X_roll = int(self.X_roll // self.dt)
-            self.X_rolled = self.data.rolling(time=self.X_roll).mean()
+            self.X_rolled = self._rolling_mean(self.X_roll)
             self.nt_offset += self.X_roll
 
         self.on_epoch_end()
@@ -190,7 +770,7 @@ class DataGenerator(keras.utils.Sequence):
         if self.y_roll is not None:
             self.y_roll = int(self.y_roll // self.dt)
             assert self.y_roll < self.nt, 'nt must be larger than y_roll'
-            self.y_rolled = self.data.isel(level=self.output_idxs).rolling(time=self.y_roll).mean()
+            self.y_rolled = self._rolling_mean(self.y_roll)
 
         if self.tfrecord_files is not None:
             self.is_tfr = True
@@ -198,29 +778,181 @@ class DataGenerator(keras.utils.Sequence):
         else:
             self.is_tfr = False
             self.tfr_dataset = None
+            if self.tf_data:
+                self._setup_tf_dataset()
 
-        if self.is_categorical:
+        self.bins = bins
+        if self.is_categorical and self.bins is None:
             if self.quantile_bins:
-                # Get a sample
-                self.is_categorical = False
-                _, y_sample = self._get_item(0)   # Assume shuffled
-                self.is_categorical = True
-
-                if 'tp' in self.output_vars:
-                    assert len(self.output_vars) == 1, 'tp must be stand-alone'
-                    y_sample = y_sample.flatten()[y_sample.flat > 0]
-                
-                self.bins = np.quantile(y_sample.flatten(), np.linspace(0, 1, self.num_bins+1))
-                self.bins[0] = -np.inf; self.bins[-1] = np.inf
+                self.bins = self._quantile_bins(norm_subsample, norm_cache_dir)
             else:
                 self.bins = np.linspace(self.bin_min, self.bin_max, self.num_bins+1)
                 self.bins[0] = -np.inf; self.bins[-1] = np.inf  # for rare out-of-bound cases.
 
+    def _quantile_bins(self, subsample, cache_dir=None):
+        """
+        Bin edges at equally spaced quantiles of the targets of every subsample-th sample. The targets are
+        reduced in one pass with a QuantileSketch. For tp only values > 0 are used. If cache_dir is given,
+        the edges are stored there next to the normalization files.
+        """
+        cache_key = hashlib.md5(repr((
+            self.cache_id, list(self.output_idxs), self.lead_time, self.min_lead_time, self.cont_time,
+            self.multi_dt, self.y_roll, self.predict_difference, self.num_bins,
+            self.mean_np.tolist(), self.std_np.tolist(), subsample
+        )).encode()).hexdigest()
+        fn = f'{cache_dir}/{cache_key}_bins.npy'
+        if cache_dir is not None and os.path.exists(fn):
+            print('Loading cached bins:', fn)
+            return np.load(fn)
+
+        is_tp = self.output_vars is not None and 'tp' in self.output_vars
+        if is_tp:
+            assert len(self.output_vars) == 1, 'tp must be stand-alone'
+        sketch = QuantileSketch()
+        self.is_categorical = False
+        idxs = np.arange(self.nt_offset, self.n_samples, subsample)
+        for start in range(0, len(idxs), self.batch_size):
+            _, y = self._get_item(None, idxs[start:start + self.batch_size])
+            sketch.add(y[y > 0] if is_tp else y)
+        self.is_categorical = True
+        bins = sketch.quantile(np.linspace(0, 1, self.num_bins+1))
+        bins[0] = -np.inf; bins[-1] = np.inf
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(fn + '.tmp', 'wb') as f:
+                np.save(f, bins)
+            os.replace(fn + '.tmp', fn)
+        return bins
+
+    def _norm_stats(self, norm_subsample, cache_dir=None, cache_key=None):
+        'Mean and std of the data. Read from cache_dir if they were computed for cache_key before.'
+        if cache_dir is not None:
+            fns = [f'{cache_dir}/{cache_key}_{stat}.nc' for stat in ['mean', 'std']]
+            if all(os.path.exists(fn) for fn in fns):
+                print('Loading cached norm files:', fns)
+                return [xr.open_dataarray(fn).load() for fn in fns]
+
+        data = self.data.isel(time=slice(0, None, norm_subsample))
+        # Constants do not vary in time, so one time step gives the same statistics
+        mean, std = [
+            xr.concat([v, c], 'level').isel(level=np.argsort(self.not_const_idxs + self.const_idxs))
+            for v, c in zip(compute_mean_std(data.isel(level=self.not_const_idxs)),
+                            compute_mean_std(data.isel(time=slice(0, 1), level=self.const_idxs)))
+        ]
+        if 'tp' in self.data.level_names:  # set tp mean to zero but not if ext
+            tp_idx = list(self.data.level_names).index('tp')
+            mean.values[tp_idx] = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for da, fn in zip([mean, std], fns):
+                da.to_netcdf(fn + '.tmp')
+                os.replace(fn + '.tmp', fn)
+        return mean, std
+
+    @property
+    def var_data(self):
+        'Non-constant levels: data_np if loaded, a BlockStream if streaming, lazy otherwise'
+        if self.data_np is not None:
+            return self.data_np
+        if self.stream is not None:
+            return self.stream
+        return self.data.isel(level=self.not_const_idxs)
+
+    def _rolling_mean(self, window):
+        'Rolling mean of var_data. If loaded, it is computed on access from one shared cumulative sum.'
+        if self.data_np is None:
+            return self.var_data.rolling(time=window).mean()
+        if self.cumsum is None:
+            self.cumsum = CumSum(self.data_np)
+        return RollingMean(self.cumsum, window)
+
+    def _normalize(self, arr, chan=None):
+        'Normalize gathered data_np channels in place if only the raw data is kept in RAM'
+        if self.normalize_batches:
+            chan = slice(None) if chan is None else _as_slice(chan)
+            np.subtract(arr, self.mean_np[chan], out=arr)
+            np.divide(arr, self.std_np[chan], out=arr)
+        return arr
+
+    def _gather(self, var_data, time_idxs, level_idxs=None, out=None):
+        """
+        Gather levels of self.data at time_idxs into out. Non-constant levels are taken from var_data,
+        constants are broadcast from const_np. If time_idxs is a (batch, n_steps) matrix, the steps are
+        stacked along the channels of out, each with all level_idxs.
+        """
+        level_idxs = np.arange(len(self.data.level)) if level_idxs is None else np.asarray(level_idxs)
+        time_idxs = np.asarray(time_idxs)
+        n_steps = time_idxs.shape[1] if time_idxs.ndim == 2 else 1
+        if out is None:
+            out = np.empty(
+                (len(time_idxs), len(self.data.lat), len(self.data.lon), n_steps * len(level_idxs)),
+                dtype='float32'
+            )
+        res = out
+        if time_idxs.ndim == 2:
+            # (batch, n_steps, lat, lon, level) view of out. Setting shape raises instead of copying.
+            out = out.view()
+            out.shape = out.shape[:3] + (n_steps, len(level_idxs))
+            out = out.transpose(0, 3, 1, 2, 4)
+        is_const = self.const_chan[level_idxs] >= 0
+        if not is_const.all():
+            pos = _as_slice(np.flatnonzero(~is_const))
+            chan = self.var_chan[level_idxs[~is_const]]
+            if type(pos) is slice:
+                self._normalize(gather(var_data, time_idxs, chan, out=out[..., pos]), chan)
+            else:
+                out[..., pos] = self._normalize(gather(var_data, time_idxs, chan), chan)
+        if is_const.any():
+            out[..., is_const] = self.const_np[..., self.const_chan[level_idxs[is_const]]]
+        return res
+
+    def _setup_samples(self):
+        """
+        Index table of the samples. Row r is the sample at time index nt_offset + r. input_idxs holds its
+        nt_in input time indices (oldest first), target_idxs its target time indices for the leads
+        (in time steps) of the current mode.
+        """
+        if self.multi_dt > 1:
+            step = self.nt // self.multi_dt
+            self.leads = np.arange(step, self.nt + step, step)
+        elif self.tfr_out or self.cont_time:
+            self.leads = np.arange(self.min_nt, self.nt + 1)
+        else:
+            self.leads = np.array([self.nt])
+        sample_idxs = np.arange(self.nt_offset, self.n_samples)
+        self.input_idxs = sample_idxs[:, None] - self.dt_in * np.arange(self.nt_in - 1, -1, -1)[None, :]
+        self.target_idxs = sample_idxs[:, None] + self.leads[None, :]
+        self.samples_key = (self.nt_offset, self.n_samples, self.nt)
+
     def on_epoch_end(self):
         'Updates indexes after each epoch'
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
+        if getattr(self, 'samples_key', None) != (self.nt_offset, self.n_samples, self.nt):
+            self._setup_samples()
+        self.epoch += 1
+        # All shards draw the same permutation
+        rng = np.random if self.num_shards == 1 else np.random.RandomState([self.shard_seed, self.epoch])
         self.idxs = np.arange(self.nt_offset, self.n_samples)
-        if self.shuffle:
-            np.random.shuffle(self.idxs)
+        if self.shuffle and self.stream is not None:
+            # Shuffle the block order, then samples within groups of stream_buffer_blocks blocks
+            sample_blocks = self.idxs // self.stream_block_size
+            blocks = np.unique(sample_blocks)
+            rng.shuffle(blocks)
+            groups = []
+            for g in range(0, len(blocks), self.stream_buffer_blocks):
+                group = self.idxs[np.isin(sample_blocks, blocks[g:g + self.stream_buffer_blocks])]
+                rng.shuffle(group)
+                groups.append(group)
+            self.idxs = np.concatenate(groups)
+        elif self.shuffle:
+            rng.shuffle(self.idxs)
+        if self.num_shards > 1:
+            # Equal shares, so that all workers run the same number of steps
+            n = len(self.idxs) // self.num_shards * self.num_shards
+            self.idxs = self.idxs[:n][self.shard_index::self.num_shards]
 
     def __len__(self):
         'Denotes the number of batches per epoch'
@@ -242,107 +974,189 @@ class DataGenerator(keras.utils.Sequence):
 
     @property
     def init_time(self):
-        stop = -self.nt
-        if self.is_tfr:
-            stop += -(self.tfr_max_lead - self.lead_time // self.dt)
-        return self.data.isel(time=slice(self.nt_offset, int(stop))).time
+        n = len(self.input_idxs)
+        if self.is_tfr and not self.tfr_time_records:
+            n -= int(self.tfr_max_lead - self.lead_time // self.dt)
+        return self.data.time.isel(time=self.input_idxs[:n, -1])
 
     @property
     def valid_time(self):
-        start = self.nt+self.nt_offset
-        stop = None
-        if self.multi_dt > 1:
-            diff = self.nt - self.nt // self.multi_dt
-            start -= diff; stop = -diff
-        if self.is_tfr:
-            stop = -int((self.tfr_max_lead - self.lead_time) // self.dt)
-            if stop == 0:
-                stop = None
-        return self.data.isel(time=slice(start, stop)).time
+        n = len(self.target_idxs)
+        if self.is_tfr and not self.tfr_time_records:
+            n -= int((self.tfr_max_lead - self.lead_time) // self.dt)
+        return self.data.time.isel(time=self.target_idxs[:n, 0 if self.multi_dt > 1 else -1])
 
     @property
     def n_samples(self):
-        return self.data.isel(time=slice(0, -self.nt)).shape[0]
+        return len(self.data.time) - self.nt
 
     def __getitem__(self, i):
         if self.tfrecord_files is None:
+            get_item = self._get_item if self.prefetcher is None else self.prefetcher.__getitem__
             if hasattr(self, 'cheat'):
-                X, y = self._get_item(i)
+                X, y = get_item(i)
                 return X, y[-1]
             else:
-                return self._get_item(i)
+                return get_item(i)
         else:
             return self._get_tfrecord_item(i)
 
-    def _get_item(self, i):
+    def _get_item(self, i, idxs=None):
         'Generate one batch of data'
-        idxs = self.idxs[i * self.batch_size:(i + 1) * self.batch_size]
-
+        if idxs is None:
+            idxs = self.idxs[i * self.batch_size:(i + 1) * self.batch_size]
+        if self.stream is not None:
+            self.stream.load(idxs)
+
+        rows = idxs - self.nt_offset
+        input_idxs = self.input_idxs[rows]
+        target_idxs = self.target_idxs[rows]
         if self.cont_time:
             if not self.fixed_time:
-                nt = np.random.randint(self.min_nt, self.nt + 1, len(idxs))
+                col = np.random.randint(0, len(self.leads), len(idxs))
             else:
-                nt = np.ones(len(idxs), dtype='int') * self.nt
-            ftime = (nt * self.dt / 100)[:, None, None] * np.ones((1, len(self.data.lat),
-                                                                   len(self.data.lon)))
+                col = np.full(len(idxs), len(self.leads) - 1)
+            nt = self.leads[col]
+            target = target_idxs[np.arange(len(idxs)), col]
         else:
-            nt = self.nt
+            target = target_idxs[:, -1]
 
         if self.X_roll is not None:
             X_data = self.X_rolled
         else:
-            X_data = self.data
-
-        X = X_data.isel(time=idxs).values.astype('float32')
-
-        if self.multi_dt > 1: consts = X[..., self.const_idxs]
+            X_data = self.var_data
+
+        # Preallocate the batch and gather the input time steps straight into it. The history steps
+        # are gathered at once with a (batch, n_steps) index matrix. With old_const every step has all
+        # levels, so the current step is part of the matrix unless it is rolled.
+        n_lev = len(self.data.level)
+        hist_data = self.var_data if self.old_const else X_data
+        hist_idxs = range(n_lev) if self.old_const else self.not_const_idxs
+        n_hist = len(hist_idxs)
+        X = np.empty(
+            (len(idxs), len(self.data.lat), len(self.data.lon),
+             n_hist * (self.nt_in - 1) + n_lev + self.cont_time),
+            dtype='float32'
+        )
+        n_steps = self.nt_in if self.old_const and self.X_roll is None else self.nt_in - 1
+        if n_steps > 0:
+            self._gather(hist_data, input_idxs[:, :n_steps], hist_idxs, out=X[..., :n_steps * n_hist])
+        c = n_hist * (self.nt_in - 1)
+        if n_steps < self.nt_in:
+            self._gather(X_data, input_idxs[:, -1], out=X[..., c:c + n_lev])
 
-        if self.nt_in > 1:
-            if self.old_const:
-                X = np.concatenate([
-                                       self.data.isel(time=idxs - nt_in * self.dt_in).values
-                                       for nt_in in range(self.nt_in - 1, 0, -1)
-                                   ] + [X], axis=-1).astype('float32')
-            else:
-                X = np.concatenate([
-                                       X_data.isel(time=idxs - nt_in * self.dt_in).values[..., self.not_const_idxs]
-                                       for nt_in in range(self.nt_in - 1, 0, -1)
-                                   ] + [X], axis=-1).astype('float32')
+        if self.cont_time:
+            X[..., -1] = (nt * self.dt / 100)[:, None, None]
 
         if self.multi_dt > 1:
+            consts = X[..., c:c + n_lev][..., self.const_idxs]
             X = [X[..., self.not_const_idxs], consts]
-            step = self.nt // self.multi_dt
-            y = [
-                self.data.isel(time=idxs + nt, level=self.output_idxs).values.astype('float32')
-                for nt in np.arange(step, self.nt + step, step)
-            ]
+            y = [self._gather(self.var_data, t, self.output_idxs) for t in target_idxs.T]
         elif self.y_roll is not None:
-            y = self.y_rolled.isel(
-                time=idxs + nt,
-            ).values.astype('float32')
+            y = self._gather(self.y_rolled, target, self.output_idxs)
         elif self.tfr_out:
             assert self.batch_size == 1, 'bs must be one'
-            time_slice = slice(idxs[0]+self.min_nt, idxs[0]+self.nt+1)
-            y = self.data.isel(time=time_slice, level=self.output_idxs).values.astype('float32')[None]
+            y = self._gather(self.var_data, target_idxs[0], self.output_idxs)[None]
         elif self.predict_difference:
-            y = (
-                self.data.isel(time=idxs + nt, level=self.output_idxs).values -
-                self.data.isel(time=idxs, level=self.output_idxs).values
-            ).astype('float32')
+            y = self._gather(self.var_data, target, self.output_idxs)
+            y -= self._gather(self.var_data, input_idxs[:, -1], self.output_idxs)
         else:
-            y = self.data.isel(time=idxs + nt, level=self.output_idxs).values.astype('float32')
+            y = self._gather(self.var_data, target, self.output_idxs)
 
         if self.is_categorical:
-            y_shape = y.shape
-            y = pd.cut(y.reshape(-1), self.bins, labels=False).reshape(y_shape)
-            y = tf.keras.utils.to_categorical(y, num_classes=self.num_bins)
-            y = y.reshape((*y_shape, self.num_bins))
+            # Bin i holds bins[i] < y <= bins[i+1]
+            y = (np.searchsorted(self.bins, y) - 1).astype('int32')
+            if not self.sparse_categorical:
+                y = np.eye(self.num_bins, dtype='float32')[y]
 
-        if self.cont_time:
-            X = np.concatenate([X, ftime[..., None]], -1).astype('float32')
         return X, y
 
 
+    def _setup_tf_dataset(self):
+        """
+        tf.data version of _get_item for loaded data. Batches of sample indices are gathered
+        from data_np inside the graph in parallel and prefetched.
+        """
+        assert self.data_np is not None, 'tf_data requires load'
+        assert not (self.multi_dt > 1 or self.y_roll or self.X_roll or self.tfr_out or
+                    self.is_categorical or self.old_const), 'Not implemented for tf_data'
+        n_var = len(self.not_const_idxs)
+        # Position of each level in [data_np channels, const_np channels]
+        perm = np.where(self.var_chan >= 0, self.var_chan, n_var + self.const_chan)
+        nlat, nlon = len(self.data.lat), len(self.data.lon)
+        # Gathered from data_np with numpy. As a graph constant the data would be copied (and limited to 2 GB).
+        data_np, dtype = self.data_np, tf.as_dtype(self.data_np.dtype)
+        const = self.const_np
+        mean, std = self.mean_np, self.std_np
+
+        def gather(t):
+            x = tf.numpy_function(lambda t: data_np[t], [t], dtype, stateful=False)
+            x.set_shape([None] + list(data_np.shape[1:]))
+            return x
+
+        def levels(t, level_idxs):
+            x = tf.cast(gather(t), tf.float32)
+            if self.normalize_batches:
+                x = (x - mean) / std
+            if (self.const_chan[level_idxs] < 0).all():
+                chan = self.var_chan[level_idxs]
+                return x if list(chan) == list(range(n_var)) else tf.gather(x, chan, axis=-1)
+            consts = tf.broadcast_to(const, [tf.shape(t)[0], nlat, nlon, len(self.const_idxs)])
+            return tf.gather(tf.concat([x, consts], -1), perm[level_idxs], axis=-1)
+
+        all_levels = np.arange(len(self.data.level))
+        input_idxs, target_idxs = self.input_idxs, self.target_idxs
+        leads = self.leads
+        def get_batch(rows):
+            inputs = tf.gather(input_idxs, rows)
+            targets = tf.gather(target_idxs, rows)
+            X = [levels(inputs[:, k], self.not_const_idxs) for k in range(self.nt_in - 1)]
+            X.append(levels(inputs[:, -1], all_levels))
+            if self.cont_time:
+                if not self.fixed_time:
+                    col = tf.random.uniform(tf.shape(rows), 0, len(leads), dtype=tf.int64)
+                else:
+                    col = tf.fill(tf.shape(rows), tf.constant(len(leads) - 1, tf.int64))
+                ftime = tf.cast(tf.gather(leads, col), tf.float32) * self.dt / 100
+                X.append(tf.broadcast_to(ftime[:, None, None, None], [tf.shape(rows)[0], nlat, nlon, 1]))
+                target = tf.gather(targets, col, batch_dims=1)
+            else:
+                target = targets[:, -1]
+            X = tf.concat(X, -1) if len(X) > 1 else X[0]
+            y = levels(target, self.output_idxs)
+            if self.predict_difference:
+                y = y - levels(inputs[:, -1], self.output_idxs)
+            return X, y
+
+        dataset = tf.data.Dataset.from_tensor_slices(np.arange(len(input_idxs)))
+        if self.shuffle:
+            dataset = dataset.shuffle(len(input_idxs), reshuffle_each_iteration=True,
+                                      seed=self.shard_seed if self.num_shards > 1 else None)
+        if self.num_shards > 1:
+            dataset = dataset.shard(self.num_shards, self.shard_index).take(len(input_idxs) // self.num_shards)
+        self.tfr_dataset = dataset.batch(self.batch_size).map(
+            get_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE
+        ).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def distributed_dataset(self):
+        """
+        The batches as a repeating tf.data.Dataset for tf.distribute strategies, with len(self) steps
+        per epoch. Auto-sharding is off, the generator shards itself (num_shards).
+        """
+        if self.tfr_dataset is not None:
+            dataset = self.tfr_dataset
+        else:
+            X, y = self._get_item(None, self.idxs[:self.batch_size])
+            assert isinstance(X, np.ndarray), 'Not implemented for multi_dt'
+            def batches():
+                for i in range(len(self)): yield self[i]
+                self.on_epoch_end()
+            spec = lambda a: tf.TensorSpec((None,) + a.shape[1:], a.dtype)
+            dataset = tf.data.Dataset.from_generator(batches, output_signature=(spec(X), spec(y)))
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset.with_options(options).repeat()
+
     def _decode(self, example_proto):
         dic = _parse(example_proto)
         X = tf.io.parse_tensor(dic['X'], np.float32)
@@ -362,6 +1176,26 @@ class DataGenerator(keras.utils.Sequence):
             y_idx = self.nt-1
             return X, y[y_idx]
 
+    def _decode_raw_batch(self, examples, manifest):
+        dic = tf.io.parse_example(examples, features)
+        dtype = tf.as_dtype(manifest['dtype'])
+        X = tf.reshape(tf.io.decode_raw(dic['X'], dtype), [-1] + manifest['X_shape'])
+        y = tf.reshape(tf.io.decode_raw(dic['y'], dtype), [-1] + manifest['y_shape'])
+        X, y = tf.cast(X, tf.float32), tf.cast(y, tf.float32)
+        if self.tfr_out_idxs is not None:
+            y = tf.gather(y, self.tfr_out_idxs, axis=-1)
+        n = tf.shape(X)[0]
+        if self.cont_time:
+            if self.fixed_time:
+                y_idx = tf.fill([n], self.nt-1)
+            else:
+                y_idx = tf.random.uniform([n], self.min_nt-1, self.nt, dtype=tf.int32)
+            y_time = tf.cast((y_idx+1) * self.dt, tf.float32) / 100
+            ftime = tf.broadcast_to(y_time[:, None, None, None], [n, len(self.data.lat), len(self.data.lon), 1])
+            return tf.concat([X, ftime], -1), tf.gather(y, y_idx, batch_dims=1)
+        else:
+            return X, y[:, self.nt-1]
+
     def _setup_tfrecord_ds(self):
         # Find all files to be used
         if type(self.tfrecord_files) is list:
@@ -369,9 +1203,44 @@ class DataGenerator(keras.utils.Sequence):
         else:
             tfr_fns = sorted(glob(self.tfrecord_files))
 
-        dataset = tf.data.TFRecordDataset(
-            tfr_fns, num_parallel_reads=self.tfr_num_parallel_calls
-        ).map(self._decode)
+        # Files written by to_tfr describe their encoding in manifest.json
+        manifest_fn = f'{os.path.dirname(tfr_fns[0])}/manifest.json'
+        manifest = {}
+        if not self.tfr_time_records and os.path.exists(manifest_fn):
+            with open(manifest_fn) as f:
+                manifest = json.load(f)
+        raw = manifest.get('dtype') is not None
+        interleave = self.tfr_interleave is not None and not self.tfr_time_records
+        parallel_calls = tf.data.AUTOTUNE if interleave else self.tfr_num_parallel_calls
+        deterministic = not (interleave and self.shuffle)
+
+        if self.tfr_time_records:
+            dataset = self._time_records_dataset(tfr_fns)
+        elif interleave:
+            files = tf.data.Dataset.from_tensor_slices(tfr_fns)
+            if self.shuffle:
+                files = files.shuffle(len(tfr_fns), reshuffle_each_iteration=True,
+                                      seed=self.shard_seed if self.num_shards > 1 else None)
+            if self.num_shards > 1:
+                # Each worker reads its own files
+                files = files.shard(self.num_shards, self.shard_index)
+            dataset = files.interleave(
+                lambda fn: tf.data.TFRecordDataset(fn, compression_type=manifest.get('compression')),
+                # Without shuffle the records stay in file order, which init_time and valid_time assume
+                cycle_length=self.tfr_interleave if self.shuffle else 1, num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=deterministic
+            )
+            if not raw:
+                dataset = dataset.map(self._decode, num_parallel_calls=tf.data.AUTOTUNE,
+                                      deterministic=deterministic)
+        else:
+            dataset = tf.data.TFRecordDataset(
+                tfr_fns, compression_type=manifest.get('compression'),
+                num_parallel_reads=self.tfr_num_parallel_calls
+            )
+            if not raw: dataset = dataset.map(self._decode)
+        if self.num_shards > 1 and not interleave:
+            dataset = dataset.shard(self.num_shards, self.shard_index)
 
         if self.shuffle:
             dataset = dataset.shuffle(
@@ -379,31 +1248,256 @@ class DataGenerator(keras.utils.Sequence):
             )
 
         self.tfr_dataset = dataset.batch(self.batch_size)
+        if raw:
+            # Parse whole batches at once
+            self.tfr_dataset = self.tfr_dataset.map(
+                lambda examples: self._decode_raw_batch(examples, manifest),
+                num_parallel_calls=parallel_calls, deterministic=deterministic
+            )
         # if self.tfr_repeat:
         #     self.tfr_dataset = self.tfr_dataset.repeat()
         if self.tfr_prefetch is not None:
             self.tfr_dataset = self.tfr_dataset.prefetch(self.tfr_prefetch)
+        elif interleave:
+            self.tfr_dataset = self.tfr_dataset.prefetch(tf.data.AUTOTUNE)
         self.tfr_dataset_np = self.tfr_dataset.as_numpy_iterator()
 
 
+    def _time_records_dataset(self, tfr_fns):
+        """
+        Samples from the time steps in a time record store (see to_time_records). Windows of consecutive
+        time steps are turned into (X, y) like in _get_item. The windows that start in a shard are read
+        from it and the beginning of the next one. If shuffle, tfr_interleave shards (default: all) are
+        read at once, in shuffled order, and their windows are interleaved. Within a shard the windows
+        stay in time order, the shuffle buffer (tfr_buffer_size) mixes them further.
+        """
+        assert not (self.multi_dt > 1 or self.y_roll or self.X_roll or self.is_categorical or
+                    self.old_const), 'Not implemented for tfr_time_records'
+        savedir = os.path.dirname(tfr_fns[0])
+        with open(f'{savedir}/index.json') as f:
+            index = json.load(f)
+        assert index['level_names'] == list(self.data.level_names.values), 'Different levels in time records'
+        assert index['times'] == [str(t) for t in self.data.time.values], 'Different times in time records'
+        shards = index['shards']
+        assert [os.path.basename(fn) for fn in tfr_fns] == [shard['file'] for shard in shards], \
+            'Not the shards of index.json'
+        const = tf.constant(np.load(f'{savedir}/const.npy'))
+        n_var = len(self.not_const_idxs)
+        perm = np.where(self.var_chan >= 0, self.var_chan, n_var + self.const_chan)
+        nlat, nlon = len(self.data.lat), len(self.data.lon)
+        all_levels = np.arange(len(self.data.level))
+        span = self.nt_offset + self.nt + 1
+        t0 = self.nt_offset
+
+        def levels(x, level_idxs):
+            if (self.const_chan[level_idxs] < 0).all():
+                return tf.gather(x, self.var_chan[level_idxs], axis=-1)
+            consts = tf.broadcast_to(const, tf.concat([tf.shape(x)[:-1], [len(self.const_idxs)]], 0))
+            return tf.gather(tf.concat([x, consts], -1), perm[level_idxs], axis=-1)
+
+        def get_sample(window):
+            X = [levels(window[t0 - k * self.dt_in], self.not_const_idxs) for k in range(self.nt_in - 1, 0, -1)]
+            X.append(levels(window[t0], all_levels))
+            nt = self.nt
+            if self.cont_time:
+                if not self.fixed_time:
+                    nt = tf.random.uniform((), self.min_nt, self.nt + 1, dtype=tf.int32)
+                X.append(tf.fill([nlat, nlon, 1], tf.cast(nt, tf.float32) * self.dt / 100))
+            X = tf.concat(X, -1) if len(X) > 1 else X[0]
+            if self.tfr_out:
+                return X, levels(window[t0 + self.min_nt:], self.output_idxs)
+            y = levels(window[t0 + nt], self.output_idxs)
+            if self.predict_difference:
+                y = y - levels(window[t0], self.output_idxs)
+            return X, y
+
+        fns = tf.constant(tfr_fns)
+        n_steps = tf.constant([shard['n_steps'] for shard in shards], tf.int64)
+        def shard_windows(k):
+            # The records of the following shards complete the last windows
+            dataset = tf.data.TFRecordDataset(fns[k:]).take(n_steps[k] + span - 1).map(
+                decode_time_record, num_parallel_calls=self.tfr_num_parallel_calls)
+            return dataset.window(span, shift=1, drop_remainder=True).flat_map(lambda w: w.batch(span))
+
+        order = tf.data.Dataset.range(len(shards))
+        if self.shuffle:
+            order = order.shuffle(len(shards), reshuffle_each_iteration=True,
+                                  seed=self.shard_seed if self.num_shards > 1 else None)
+        dataset = order.interleave(
+            shard_windows, cycle_length=(self.tfr_interleave or len(shards)) if self.shuffle else 1)
+        return dataset.map(get_sample, num_parallel_calls=self.tfr_num_parallel_calls)
+
     def _get_tfrecord_item(self, i):
         X, y = next(self.tfr_dataset_np)
         return X, y
 
-    def to_tfr(self, savedir, steps_per_file=250):
-        assert self.batch_size == 1, 'bs must be one'
-        for i, (X, y) in tqdm(enumerate(self)):
-            if i % steps_per_file == 0:
-                c = int(np.floor(i / steps_per_file))
-                fn = f'{savedir}/{str(c).zfill(3)}.tfrecord'
-                print('Writing to file:', fn)
-                writer = tf.io.TFRecordWriter(fn)
-            serialized_example = serialize_example(X[0], y[0])  # Remove batch dimension
-            writer.write(serialized_example)
-            if i + 1 % steps_per_file == 0:
-                writer.close()
-        writer.close()
+    def to_tfr(self, savedir, steps_per_file=250, num_workers=1, seed=0, raw_dtype=None, compression=None):
+        """
+        Write all samples to TFRecord shards of steps_per_file samples in savedir, using num_workers
+        processes. Samples are assigned to shards in a fixed order (permuted with seed if shuffle), so an
+        interrupted run can be restarted and skips complete shards. manifest.json lists the shards with
+        their number of samples and range of init times.
+        raw_dtype: If given (float16 or float32), store the arrays as raw bytes of this dtype, which are
+            parsed a batch at a time when reading. Otherwise serialized tensors are stored.
+        compression: None, 'ZLIB' or 'GZIP'
+        """
+        idxs = np.arange(self.nt_offset, self.n_samples)
+        if self.shuffle:
+            idxs = np.random.RandomState(seed).permutation(idxs)
+        shards, manifest = [], []
+        for c, start in enumerate(range(0, len(idxs), steps_per_file)):
+            shard_idxs = idxs[start:start + steps_per_file]
+            fn = f'{savedir}/{str(c).zfill(3)}.tfrecord'
+            times = self.data.time.values[shard_idxs]
+            manifest.append({'file': os.path.basename(fn), 'n_samples': len(shard_idxs),
+                             'start': str(times.min()), 'stop': str(times.max())})
+            if not os.path.exists(fn):
+                shards.append((fn, shard_idxs, raw_dtype, compression))
+        print(f'Writing {len(shards)} of {len(manifest)} shards to {savedir}')
+
+        _write_shards(self, _write_tfr_shard, shards, num_workers)
+
+        X, y = self._get_item(None, idxs[:1])
+        with open(f'{savedir}/manifest.json', 'w') as f:
+            json.dump({'n_samples': len(idxs), 'steps_per_file': steps_per_file, 'dtype': raw_dtype,
+                       'compression': compression, 'X_shape': list(X.shape[1:]), 'y_shape': list(y.shape[1:]),
+                       'shards': manifest}, f, indent=1)
+
+    def to_time_records(self, savedir, steps_per_file=1000, num_workers=1):
+        """
+        Write every time step of the normalized data once, to TFRecord shards of steps_per_file consecutive
+        time steps. const.npy holds the normalized constants, index.json the times, levels and shards.
+        Read them with tfr_time_records=True, which assembles the samples for any lead_time, nt_in, dt_in
+        and min_lead_time. Complete shards are skipped when an interrupted run is restarted.
+        """
+        times = [str(t) for t in self.data.time.values]
+        shards, manifest = [], []
+        for c, start in enumerate(range(0, len(times), steps_per_file)):
+            stop = min(start + steps_per_file, len(times))
+            fn = f'{savedir}/{str(c).zfill(3)}.tfrecord'
+            manifest.append({'file': os.path.basename(fn), 'n_steps': stop - start,
+                             'start': times[start], 'stop': times[stop - 1]})
+            if not os.path.exists(fn):
+                shards.append((fn, np.arange(start, stop)))
+        print(f'Writing {len(shards)} of {len(manifest)} shards to {savedir}')
+        _write_shards(self, _write_time_shard, shards, num_workers)
+
+        np.save(f'{savedir}/const.npy', self.const_np)
+        with open(f'{savedir}/index.json', 'w') as f:
+            json.dump({'times': times, 'level_names': list(self.data.level_names.values),
+                       'steps_per_file': steps_per_file, 'shards': manifest}, f, indent=1)
+
+
+_tfr_dg = None  # DataGenerator that is written to TFRecords, inherited by forked workers
+
+def _write_shards(dg, write_shard, shards, num_workers):
+    global _tfr_dg
+    _tfr_dg = dg
+    if num_workers > 1:
+        # Forked workers share the loaded data with this process
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(write_shard, shards), total=len(shards)): pass
+    else:
+        for shard in tqdm(shards): write_shard(shard)
+    _tfr_dg = None
+
+def _write_records(fn, records, times, compression=None):
+    """
+    Write the serialized records to fn. The file only appears under its name once it is complete.
+    For uncompressed files, fn.index.npz holds the byte offset, length and time of each record.
+    """
+    offsets, lengths, offset = [], [], 0
+    with tf.io.TFRecordWriter(fn + '.tmp', compression) as writer:
+        for record in records:
+            writer.write(record)
+            offsets.append(offset); lengths.append(len(record))
+            offset += len(record) + 16  # length (8), its crc (4), data, data crc (4)
+    if compression is None:
+        np.savez(fn + '.index.tmp.npz', offsets=offsets, lengths=lengths, times=times)
+        os.replace(fn + '.index.tmp.npz', fn + '.index.npz')
+    os.replace(fn + '.tmp', fn)
+    return fn
+
+def _write_tfr_shard(shard):
+    'Write the samples of a shard'
+    fn, idxs, raw_dtype, compression = shard
+    dg = _tfr_dg
+    def records():
+        for start in range(0, len(idxs), dg.batch_size):
+            X, y = dg._get_item(None, idxs[start:start + dg.batch_size])
+            for j in range(len(X)):
+                if raw_dtype is None:
+                    yield serialize_example(X[j], y[j])
+                else:
+                    yield serialize_raw_example(X[j], y[j], raw_dtype)
+    return _write_records(fn, records(), dg.data.time.values[idxs], compression)
+
+def _write_time_shard(shard):
+    'Write the normalized non-constant levels of consecutive time steps, one record per time step'
+    fn, time_idxs = shard
+    dg = _tfr_dg
+    def records():
+        for start in range(0, len(time_idxs), 64):
+            t = time_idxs[start:start + 64]
+            x = dg._gather(dg.var_data, t, dg.not_const_idxs)
+            for j in range(len(t)):
+                yield serialize_time_record(x[j], t[j])
+    return _write_records(fn, records(), dg.data.time.values[time_idxs])
+
+
+class TFRecordIndex(object):
+    """
+    Random access to the records in a directory of shards written by to_tfr or to_time_records, using the
+    .index.npz files next to the shards. Records are addressed by their position in the sorted shards or
+    by their time (init time for to_tfr, time step for to_time_records).
+    """
+    def __init__(self, savedir):
+        self.fns = sorted(glob(f'{savedir}/*.tfrecord'))
+        assert self.fns, f'No TFRecord files in {savedir}'
+        index = [np.load(fn + '.index.npz') for fn in self.fns]
+        self.file = np.concatenate([np.full(len(i['offsets']), c) for c, i in enumerate(index)])
+        self.offsets = np.concatenate([i['offsets'] for i in index])
+        self.lengths = np.concatenate([i['lengths'] for i in index])
+        self.times = pd.DatetimeIndex(np.concatenate([i['times'] for i in index]))
+        self.manifest = {}
+        if os.path.exists(f'{savedir}/manifest.json'):
+            with open(f'{savedir}/manifest.json') as f:
+                self.manifest = json.load(f)
 
+    def __len__(self):
+        return len(self.offsets)
+
+    def time_idxs(self, times):
+        idxs = self.times.get_indexer(pd.DatetimeIndex(np.atleast_1d(times)))
+        if (idxs < 0).any(): raise KeyError('Times not in the TFRecord files')
+        return idxs
+
+    def read(self, idxs):
+        'Serialized records, read in file order'
+        idxs = np.atleast_1d(idxs)
+        records = [None] * len(idxs)
+        for c in np.unique(self.file[idxs]):
+            with open(self.fns[c], 'rb') as f:
+                for j in np.where(self.file[idxs] == c)[0]:
+                    f.seek(self.offsets[idxs[j]] + 12)
+                    records[j] = f.read(self.lengths[idxs[j]])
+        return records
+
+    def _decode(self, name, value):
+        if self.manifest.get('dtype') is None:
+            return tf.make_ndarray(TensorProto.FromString(value))
+        return np.frombuffer(value, self.manifest['dtype']).reshape(self.manifest[f'{name}_shape'])
+
+    def __getitem__(self, idxs):
+        'Stacked arrays of the records: X, y for to_tfr, x for to_time_records'
+        examples = [tf.train.Example.FromString(r).features.feature for r in self.read(idxs)]
+        names = [n for n in ['X', 'y', 'x'] if n in examples[0]]
+        out = [np.stack([self._decode(n, e[n].bytes_list.value[0]) for e in examples]).astype('float32')
+               for n in names]
+        return tuple(out) if len(out) > 1 else out[0]
+
+    def sel(self, times):
+        return self[self.time_idxs(times)]
 
 
 class CombinedDataGenerator(keras.utils.Sequence):
@@ -534,6 +1628,7 @@ def create_cont_predictions(model, dg, max_lead_time=120, dt=12, lead_time=None)
     for l in tqdm(lead_time):
         dg.lead_time = l.values; dg.on_epoch_end()
         if dg.is_tfr: dg._setup_tfrecord_ds()
+        elif dg.tf_data: dg._setup_tf_dataset()
         p = create_predictions(model, dg)
         p['time'] = dg.init_time
         preds.append(p)
@@ -0,0 +1,86 @@
+"""
+Index of the netCDF files in a data directory tree. Opening many yearly files with
+xr.open_mfdataset(..., combine='by_coords') reads and compares the coordinates of every file. With an
+index the files are put in time order from the index and concatenated without these checks.
+"""
+import os
+import json
+import numpy as np
+import xarray as xr
+from glob import glob
+from fire import Fire
+
+INDEX_NAME = 'nc_index.json'
+
+def _stat(fn):
+    st = os.stat(fn)
+    return st.st_mtime, st.st_size
+
+def _file_meta(fn):
+    'Variables, time range, levels and chunk layout of a file'
+    mtime, size = _stat(fn)
+    with xr.open_dataset(fn) as ds:
+        return {
+            'mtime': mtime, 'size': size,
+            'variables': list(ds.data_vars),
+            'time': [str(ds.time.values[0]), str(ds.time.values[-1]), len(ds.time)] if 'time' in ds.dims else None,
+            'levels': ds.level.values.tolist() if 'level' in ds.dims else None,
+            'chunks': {v: ds[v].encoding.get('chunksizes') and list(ds[v].encoding['chunksizes'])
+                       for v in ds.data_vars}
+        }
+
+def build_index(datadir, pattern='**/*.nc'):
+    """
+    Write datadir/nc_index.json for all files matching pattern. Files that are already indexed with the
+    same mtime and size are not opened again.
+    """
+    fn_index = f'{datadir}/{INDEX_NAME}'
+    index = {}
+    if os.path.exists(fn_index):
+        with open(fn_index) as f:
+            index = json.load(f)
+    files = {}
+    for fn in sorted(glob(f'{datadir}/{pattern}', recursive=True)):
+        rel = os.path.relpath(fn, datadir)
+        meta = index.get(rel)
+        if meta is None or (meta['mtime'], meta['size']) != _stat(fn):
+            meta = _file_meta(fn)
+        files[rel] = meta
+    with open(fn_index + '.tmp', 'w') as f:
+        json.dump(files, f)
+    os.replace(fn_index + '.tmp', fn_index)
+    print(f'Indexed {len(files)} files in {fn_index}')
+    return files
+
+def find_index(path):
+    'Closest nc_index.json in path or its parents. Returns its directory and content, or None, None.'
+    path = os.path.abspath(path)
+    while True:
+        if os.path.exists(f'{path}/{INDEX_NAME}'):
+            with open(f'{path}/{INDEX_NAME}') as f:
+                return path, json.load(f)
+        if os.path.dirname(path) == path: return None, None
+        path = os.path.dirname(path)
+
+def open_mfdataset(fns, **kwargs):
+    """
+    Same as xr.open_mfdataset(fns, combine='by_coords', **kwargs) for yearly files. If an index covers all
+    files and is up to date, they are concatenated along time in the indexed order, without reading and
+    comparing their coordinates. fns is a list of files or a glob pattern.
+    """
+    fns = sorted(glob(fns)) if type(fns) is str else list(fns)
+    root, index = find_index(os.path.dirname(fns[0]))
+    metas = [index.get(os.path.relpath(os.path.abspath(fn), root)) for fn in fns] if index else [None]
+    stale = index is None or any(m is None or (m['mtime'], m['size']) != _stat(fn) for fn, m in zip(fns, metas))
+    if stale and index:
+        print(f'{root}/{INDEX_NAME} is out of date for {os.path.dirname(fns[0])}, rebuild it with build_index')
+    if stale or any(m['time'] is None for m in metas):
+        return xr.open_mfdataset(fns, combine='by_coords', **kwargs)
+    order = np.argsort([np.datetime64(m['time'][0]) for m in metas])
+    return xr.open_mfdataset(
+        [fns[i] for i in order], combine='nested', concat_dim='time',
+        data_vars='minimal', coords='minimal', compat='override', join='override', **kwargs
+    )
+
+if __name__ == '__main__':
+    Fire(build_index)
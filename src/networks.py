@@ -420,7 +420,8 @@ def create_lat_log_loss(lat, n_vars):
 
     return log_loss
 
-def create_lat_categorical_loss(lat, n_vars):
+def create_lat_categorical_loss(lat, n_vars, sparse=False):
+    """sparse: y_true holds bin indices (batch, lat, lon, n_vars) instead of one-hot vectors"""
     weights_lat = np.cos(np.deg2rad(lat)).values
     weights_lat /= weights_lat.mean()
 
@@ -430,7 +431,12 @@ def create_lat_categorical_loss(lat, n_vars):
         for i in range(n_vars):
             loss += cce(y_true[:,:,:,i,:], y_pred[:,:,:,i,:])*weights_lat[None, :, None]
         return loss
-    return categorical_loss
+
+    def sparse_categorical_loss(y_true, y_pred):
+        scce = tf.keras.losses.sparse_categorical_crossentropy
+        return tf.reduce_sum(scce(y_true, y_pred) * weights_lat[None, :, None, None], -1)
+
+    return sparse_categorical_loss if sparse else categorical_loss
 
 
 # Agrawal et al version
@@ -5,6 +5,7 @@ import numpy as np
 import xarray as xr
 #import properscoring as ps
 import xskillscore as xs
+from src.data_index import open_mfdataset
 
 def load_test_data(path, var, years=slice('2017', '2018'), cmip=False):
     """
@@ -16,7 +17,7 @@ def load_test_data(path, var, years=slice('2017', '2018'), cmip=False):
         dataset: Concatenated dataset for 2017 and 2018
     """
     assert var in ['z', 't'], 'Test data only for Z500 and T850'
-    ds = xr.open_mfdataset(f'{path}/*.nc', combine='by_coords')[var]
+    ds = open_mfdataset(f'{path}/*.nc')[var]
     if cmip:
         ds['plev'] /= 100
         ds = ds.rename({'plev': 'level'})
@@ -4,6 +4,7 @@ from src.networks import *
 from src.utils import *
 from src.regrid import regrid
 from src.clr import OneCycleLR
+from src.data_index import open_mfdataset
 import os
 import ast, re
 import numpy as np
@@ -26,45 +27,109 @@ class LRUpdate(object):
         print(f'Learning rate = {lr}')
         return lr
 
+def year_files(pattern, years=None):
+    """Files matching pattern. With years, a list of (first, last) years, only those whose year is in a range."""
+    fns = sorted(glob(pattern))
+    if years is None: return fns
+    def keep(fn):
+        m = re.search(r'(?<![\d.])((?:19|20)\d\d)(?!\d)', os.path.basename(fn))
+        return m is None or any(first <= int(m.group(1)) <= last for first, last in years)
+    return [fn for fn in fns if keep(fn)]
+
+def open_var(fns, levels=None, level_dim='level', level_scale=1):
+    'Open the files of one variable, reading only levels'
+    def preprocess(d):
+        if levels is None or level_dim not in d.dims: return d
+        return d.sel({level_dim: np.array(levels) * level_scale})
+    return open_mfdataset(fns, preprocess=preprocess)
+
+def open_dataset(var_dict, datadir, cmip, cmip_dir, zarr_store=None, years=None):
+    """
+    Open the variables in var_dict, only the files of years and the levels in var_dict.
+    Returns the dataset and the files it was read from.
+    """
+    if zarr_store is not None:
+        # Stacked store written by convert_to_zarr
+        store = xr.open_zarr(zarr_store, consolidated=True)
+        ds = store['data']
+        if 'constants' in store:
+            # Stored once, broadcast along time without copies like in stack_levels
+            const = store['constants'].rename({'const_level': 'level', 'const_names': 'level_names'})
+            ds = xr.concat([ds, const.expand_dims({'time': ds.time}).transpose(*ds.dims)], 'level')
+        data_files = [fn for fn in [f'{zarr_store}/zarr.json', f'{zarr_store}/.zmetadata'] if os.path.exists(fn)]
+        return ds, data_files
+
+    tmp_dict = var_dict.copy()
+    constants = tmp_dict.pop('constants', None)
+    if cmip:
+        var_files = {var: year_files(f'{cmip_dir}/{var}/*.nc', years) for var in tmp_dict.keys()}
+    else:
+        var_files = {var: year_files(f'{datadir}/{var}/*.nc', years) for var in tmp_dict.keys()}
+    if constants is not None:
+        var_files['constants'] = year_files(f'{datadir}/constants/*.nc')
+    ds = xr.merge(
+        [open_var(fns, None if var == 'constants' else tmp_dict[var][1],
+                  'plev' if cmip else 'level', 100 if cmip else 1)
+         for var, fns in var_files.items()],
+        fill_value=0  # For the 'tisr' NaNs
+    )
+    if cmip:
+        ds = ds.assign_coords(plev= ds['plev'] / 100)
+        ds = ds.rename({'plev': 'level'})
+    return ds, [fn for fns in var_files.values() for fn in fns]
+
 def load_data(var_dict, datadir, cmip, cmip_dir, train_years, valid_years, test_years,
               lead_time, batch_size, output_vars, data_subsample, norm_subsample,
-              nt_in, dt_in, only_test=False, ext_mean=None, ext_std=None, cont_time=False,
+              nt_in, dt_in, only_test=False, ext_mean=None, ext_std=None, ext_bins=None, cont_time=False,
               multi_dt=1, verbose=0,
               train_tfr_files=None, valid_tfr_files=None, test_tfr_files=None, tfr_num_parallel_calls=1,
               tfr_buffer_size=1000, tfr_prefetch=None, y_roll=None, X_roll=None, discard_first=None,
               min_lead_time=None, tp_log=None, tfr_out=False, tfr_out_idxs=None,
               predict_difference=False, is_categorical=False, bin_min=None, bin_max=None,
               num_bins=None, quantile_bins=False,
+              normalize_batches=False,
+              prefetch_workers=0,
+              prefetch_size=4,
+              tf_data=False,
+              stream_block_size=None,
+              stream_buffer_blocks=8,
+              norm_cache_dir=None,
+              sparse_categorical=False,
+              storage_dtype='float32',
+              tfr_time_records=False,
+              tfr_interleave=None,
+              zarr_store=None,
+              load_workers=None,
+              prefetch_processes=False,
+              num_shards=1,
+              shard_index=0,
               **kwargs):
     if type(ext_mean) is str: ext_mean = xr.open_dataarray(ext_mean)
     if type(ext_std) is str: ext_std = xr.open_dataarray(ext_std)
+    if type(ext_bins) is str: ext_bins = np.load(ext_bins)
 
     # Open dataset and create data generators
-    if cmip:
+    years = [test_years] if only_test else [train_years, valid_years, test_years]
+    years = [(int(str(first)[:4]), int(str(last)[:4])) for first, last in years]
+    ds, data_files = open_dataset(var_dict, datadir, cmip, cmip_dir, zarr_store, years)
 
-        # Load vars
-        tmp_dict = var_dict.copy()
-        constants = tmp_dict.pop('constants')
-        ds = xr.merge(
-            [xr.open_mfdataset(f'{cmip_dir}/{var}/*.nc', combine='by_coords')
-             for var in tmp_dict.keys()] +
-            [xr.open_mfdataset(f'{datadir}/constants/*.nc', combine='by_coords')],
-            fill_value=0  # For the 'tisr' NaNs
-        )
-        # pdb.set_trace()
-        ds = ds.assign_coords(plev= ds['plev'] / 100)
-        ds = ds.rename({'plev': 'level'})
-    else:
-        ds = xr.merge(
-            [xr.open_mfdataset(f'{datadir}/{var}/*.nc', combine='by_coords')
-             for var in var_dict.keys()],
-            fill_value=0  # For the 'tisr' NaNs
-        )
+    # Keys the cached normalization statistics
+    data_fingerprint = files_fingerprint(data_files) if norm_cache_dir else None
 
     ds_train = ds.sel(time=slice(*train_years))
     ds_valid = ds.sel(time=slice(*valid_years))
     ds_test = ds.sel(time=slice(*test_years))
 
+    # Load the data once for all generators that keep it in RAM
+    shared_data = None
+    if not only_test and stream_block_size is None:
+        splits = [(ds_train, discard_first, train_tfr_files), (ds_valid, None, valid_tfr_files),
+                  (ds_test, None, test_tfr_files)]
+        times = [d.time.values[discard::data_subsample] for d, discard, tfr_files in splits
+                 if tfr_files is None]
+        if times:
+            shared_data = SharedData(ds, var_dict, times, tp_log=tp_log)
+
     if not only_test:
         dg_train = DataGenerator(
             ds_train, var_dict, lead_time, batch_size=batch_size, output_vars=output_vars,
@@ -77,7 +142,18 @@ def load_data(var_dict, datadir, cmip, cmip_dir, train_years, valid_years, test_
             tfr_prefetch=tfr_prefetch, y_roll=y_roll, X_roll=X_roll, discard_first=discard_first,
             min_lead_time=min_lead_time, tp_log=tp_log, verbose=1, tfr_out=tfr_out,
             tfr_out_idxs=tfr_out_idxs, predict_difference=predict_difference,
-            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins, quantile_bins=quantile_bins
+            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins, quantile_bins=quantile_bins,
+            bins=ext_bins,
+            normalize_batches=normalize_batches,
+            prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+            stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+            norm_cache_dir=norm_cache_dir, data_fingerprint=data_fingerprint, shared_data=shared_data,
+            sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+            tfr_time_records=tfr_time_records,
+            tfr_interleave=tfr_interleave,
+            load_workers=load_workers,
+            prefetch_processes=prefetch_processes,
+            num_shards=num_shards, shard_index=shard_index
         )
 
         dg_valid = DataGenerator(
@@ -95,7 +171,16 @@ def load_data(var_dict, datadir, cmip, cmip_dir, train_years, valid_years, test_
             tfr_repeat=False,
             min_lead_time=min_lead_time, tp_log=tp_log, tfr_out=tfr_out,
             tfr_out_idxs=tfr_out_idxs, predict_difference=predict_difference,
-            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins, quantile_bins=quantile_bins
+            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins, quantile_bins=quantile_bins,
+            bins=ext_bins if ext_bins is not None else dg_train.bins,
+            normalize_batches=normalize_batches,
+            prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+            stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+            shared_data=shared_data, sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+            tfr_time_records=tfr_time_records,
+            load_workers=load_workers,
+            prefetch_processes=prefetch_processes,
+            num_shards=num_shards, shard_index=shard_index
         )
 
     dg_test = DataGenerator(
@@ -114,7 +199,15 @@ def load_data(var_dict, datadir, cmip, cmip_dir, train_years, valid_years, test_
         min_lead_time=min_lead_time, tp_log=tp_log, tfr_out=tfr_out,
         tfr_out_idxs=tfr_out_idxs, predict_difference=predict_difference,
         is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins, 
-        quantile_bins=quantile_bins
+        quantile_bins=quantile_bins,
+        bins=ext_bins if ext_bins is not None else dg_train.bins,
+        normalize_batches=normalize_batches,
+        prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+        stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+        shared_data=shared_data, sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+        tfr_time_records=tfr_time_records,
+        load_workers=load_workers,
+        prefetch_processes=prefetch_processes
     )
     if only_test:
         return dg_test
@@ -129,13 +222,28 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
          bn_position, nt_in, dt_in, use_bias, l2, skip, dropout,
          reduce_lr_patience, reduce_lr_factor, min_lr_times, unres, loss,
          cmip, cmip_dir, pretrained_model, last_pretrained_layer, last_trainable_layer,
-         min_es_delta, optimizer, activation, ext_mean, ext_std, cont_time, multi_dt, momentum,
+         min_es_delta, optimizer, activation, ext_mean, ext_std, ext_bins, cont_time, multi_dt, momentum,
          parametric, one_cycle, long_skip,
          train_tfr_files, valid_tfr_files, test_tfr_files,
          tfr_num_parallel_calls, tfr_buffer_size,
          tfr_prefetch, y_roll, X_roll, discard_first, min_lead_time, relu_idxs, tp_log, tfr_out_idxs,
          predict_difference, is_categorical, bin_min, bin_max, num_bins,
          quantile_bins,
+         normalize_batches,
+         prefetch_workers,
+         prefetch_size,
+         tf_data,
+         stream_block_size,
+         stream_buffer_blocks,
+         norm_cache_dir,
+         sparse_categorical,
+         storage_dtype,
+         tfr_time_records,
+         tfr_interleave,
+         zarr_store,
+         load_workers,
+         prefetch_processes,
+         multi_worker,
          **kwargs
       ):
     print(type(var_dict))
@@ -144,9 +252,23 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
     # # Limit TF memory usage
     # limit_mem()
     os.environ["CUDA_VISIBLE_DEVICES"] = ','.join([str(g) for g in gpu])
-    mirrored_strategy = tf.distribute.MirroredStrategy(
-        devices=[f"/gpu:{i}" for i, g in enumerate(gpu)]
-    )
+    if multi_worker:
+        # Cluster from TF_CONFIG. Each worker trains on its shard of the samples.
+        mirrored_strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        resolver = mirrored_strategy.cluster_resolver
+        cluster = resolver.cluster_spec().as_dict()
+        n_chief = len(cluster.get('chief', []))
+        num_shards = n_chief + len(cluster.get('worker', [])) or 1
+        # The chief trains too, as rank 0 before the workers
+        shard_index = (resolver.task_id or 0) + (n_chief if resolver.task_type == 'worker' else 0)
+        # Without a chief task, worker 0 is the chief
+        is_chief = resolver.task_type in (None, 'chief') or (
+            resolver.task_type == 'worker' and n_chief == 0 and resolver.task_id == 0)
+    else:
+        mirrored_strategy = tf.distribute.MirroredStrategy(
+            devices=[f"/gpu:{i}" for i, g in enumerate(gpu)]
+        )
+        num_shards, shard_index, is_chief = 1, 0, True
 
     # Mixed precicion policy
     policy = mixed_precision.Policy('mixed_float16')
@@ -160,7 +282,7 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
                 dgtr, dgv, dgte = load_data(
                     var_dict, datadir, cmip, cd, train_years, valid_years, test_years,
                     lead_time, batch_size, output_vars, data_subsample, norm_subsample,
-                    nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, cont_time=cont_time,
+                    nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, ext_bins=ext_bins, cont_time=cont_time,
                     multi_dt=multi_dt,
                     train_tfr_files=train_tfr_files, valid_tfr_files=valid_tfr_files,
                     test_tfr_files=test_tfr_files,
@@ -169,7 +291,16 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
                     tfr_prefetch=tfr_prefetch, y_roll=y_roll, X_roll=X_roll, discard_first=discard_first,
                     min_lead_time=min_lead_time, tp_log=tp_log, tfr_out_idxs=tfr_out_idxs,
                     predict_difference=predict_difference,
-                    is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins
+                    is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins,
+                    normalize_batches=normalize_batches,
+                    prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+                    stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+                    norm_cache_dir=norm_cache_dir, sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+                    tfr_time_records=tfr_time_records,
+                    tfr_interleave=tfr_interleave, zarr_store=zarr_store,
+                    load_workers=load_workers,
+                    prefetch_processes=prefetch_processes,
+                    num_shards=num_shards, shard_index=shard_index
                 )
                 dg_train.append(dgtr); dg_valid.append(dgv); dg_test.append(dgte)
             dg_train, dg_valid, dg_test = [
@@ -178,7 +309,7 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
             dg_train, dg_valid, dg_test = load_data(
                 var_dict, datadir, cmip, cmip_dir[0], train_years, valid_years, test_years,
                 lead_time, batch_size, output_vars, data_subsample, norm_subsample,
-                nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, cont_time=cont_time,
+                nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, ext_bins=ext_bins, cont_time=cont_time,
                 multi_dt=multi_dt,
                 train_tfr_files=train_tfr_files, valid_tfr_files=valid_tfr_files,
                 test_tfr_files=test_tfr_files,
@@ -187,13 +318,22 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
                 tfr_prefetch=tfr_prefetch, y_roll=y_roll, X_roll=X_roll, discard_first=discard_first,
                 min_lead_time=min_lead_time, tp_log=tp_log, tfr_out_idxs=tfr_out_idxs,
                 predict_difference=predict_difference,
-                is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins
+                is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins,
+                normalize_batches=normalize_batches,
+                prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+                stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+                norm_cache_dir=norm_cache_dir, sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+                tfr_time_records=tfr_time_records,
+                tfr_interleave=tfr_interleave, zarr_store=zarr_store,
+                load_workers=load_workers,
+                prefetch_processes=prefetch_processes,
+                num_shards=num_shards, shard_index=shard_index
             )
     else:
         dg_train, dg_valid, dg_test = load_data(
             var_dict, datadir, cmip, cmip_dir, train_years, valid_years, test_years,
             lead_time, batch_size, output_vars, data_subsample, norm_subsample,
-            nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, cont_time=cont_time,
+            nt_in, dt_in, ext_mean=ext_mean, ext_std=ext_std, ext_bins=ext_bins, cont_time=cont_time,
             multi_dt=multi_dt,
             train_tfr_files=train_tfr_files, valid_tfr_files=valid_tfr_files,
             test_tfr_files=test_tfr_files,
@@ -202,7 +342,16 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
             tfr_prefetch=tfr_prefetch, y_roll=y_roll, X_roll=X_roll, discard_first=discard_first,
             min_lead_time=min_lead_time, tp_log=tp_log, tfr_out_idxs=tfr_out_idxs,
             predict_difference=predict_difference,
-            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins
+            is_categorical=is_categorical, bin_min=bin_min, bin_max=bin_max, num_bins=num_bins,quantile_bins=quantile_bins,
+            normalize_batches=normalize_batches,
+            prefetch_workers=prefetch_workers, prefetch_size=prefetch_size, tf_data=tf_data,
+            stream_block_size=stream_block_size, stream_buffer_blocks=stream_buffer_blocks,
+            norm_cache_dir=norm_cache_dir, sparse_categorical=sparse_categorical, storage_dtype=storage_dtype,
+            tfr_time_records=tfr_time_records,
+            tfr_interleave=tfr_interleave, zarr_store=zarr_store,
+            load_workers=load_workers,
+            prefetch_processes=prefetch_processes,
+            num_shards=num_shards, shard_index=shard_index
         )
 
     # Build model
@@ -263,7 +412,10 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
         if loss == 'lat_log_loss':
             loss = create_lat_log_loss(dg_train.data.lat, len(dg_train.output_idxs))
         if loss == 'lat_categorical_crossentropy':
-            loss = create_lat_categorical_loss(dg_train.data.lat, len(dg_train.output_idxs))
+            loss = create_lat_categorical_loss(dg_train.data.lat, len(dg_train.output_idxs),
+                                               sparse=sparse_categorical)
+        if loss == 'categorical_crossentropy' and sparse_categorical:
+            loss = 'sparse_categorical_crossentropy'
             
         if optimizer == 'adam':
             opt = keras.optimizers.Adam(lr)
@@ -308,12 +460,30 @@ def train(datadir, var_dict, output_vars, filters, kernels, lr, batch_size, earl
         ))
 
     # Train model
+    if multi_worker:
+        # Each worker feeds its own shard. Its batches are per-replica batches, not split again by Keras.
+        train_data, valid_data = [mirrored_strategy.distribute_datasets_from_function(
+            lambda ctx, dg=dg: dg.distributed_dataset()) for dg in [dg_train, dg_valid]]
+        # The same number of steps on all workers, a step takes one batch per local replica
+        local_replicas = mirrored_strategy.num_replicas_in_sync // num_shards
+        steps = dict(steps_per_epoch=len(dg_train) // local_replicas,
+                     validation_steps=len(dg_valid) // local_replicas)
+    else:
+        train_data, valid_data = dg_train.tfr_dataset or dg_train, dg_valid.tfr_dataset or dg_valid
+        steps = {}
     history = model.fit(
-        dg_train.tfr_dataset or dg_train,
+        train_data,
         epochs=epochs,
-        validation_data=dg_valid.tfr_dataset or dg_valid,
-        callbacks=callbacks
+        validation_data=valid_data,
+        callbacks=callbacks,
+        shuffle=False,  # The generators shuffle themselves. Keeps streamed blocks in order.
+        **steps
     )
+    if not is_chief:
+        # Only the chief saves and predicts, the other workers save to their own directory
+        os.makedirs(f'{model_save_dir}/worker_{shard_index}', exist_ok=True)
+        model.save(f'{model_save_dir}/worker_{shard_index}/{exp_id}.h5')
+        return
     print(f'Saving model: {model_save_dir}/{exp_id}.h5')
     model.save(f'{model_save_dir}/{exp_id}.h5')
     print(f'Saving model weights: {model_save_dir}/{exp_id}_weights.h5')
@@ -357,6 +527,7 @@ def load_args(my_config=None):
     p = ArgParser()
     p.add_argument('-c', '--my-config', is_config_file=True, help='config file path', default=my_config)
     p.add_argument('--datadir', type=str, required=True, help='Path to data')
+    p.add_argument('--zarr_store', type=str, default=None, help='Read the data from a store written by convert_to_zarr')
     p.add_argument('--exp_id', type=str, required=True, help='Experiment identifier')
     p.add_argument('--model_save_dir', type=str, required=True, help='Path to save model')
     p.add_argument('--pred_save_dir', type=str, required=True, help='Path to save predictions')
@@ -407,6 +578,7 @@ def load_args(my_config=None):
     p.add_argument('--last_trainable_layer', type=str, default=None, help='Name of last trainable layer')
     p.add_argument('--ext_mean', type=str, default=None, help='External normalization mean')
     p.add_argument('--ext_std', type=str, default=None, help='External normalization std')
+    p.add_argument('--ext_bins', type=str, default=None, help='External bin edges (.npy) for is_categorical')
     p.add_argument('--cont_time', type=int, default=0, help='Continuous time 0/1')
     p.add_argument('--multi_dt', type=int, default=1, help='Differentiate through multiple time steps')
     p.add_argument('--parametric', type=int, default=0, help='Is parametric')
@@ -435,10 +607,24 @@ def load_args(my_config=None):
 
     p.add_argument('--predict_difference', type=int, default=0, help='')
     p.add_argument('--is_categorical', type=int, default=0, help='')
+    p.add_argument('--sparse_categorical', type=int, default=0, help='Categorical targets as bin indices instead of one-hot')
     p.add_argument('--bin_min', type=float, default=None, help='')
     p.add_argument('--bin_max', type=float, default=None, help='')
     p.add_argument('--num_bins', type=int, default=None, help='')
     p.add_argument('--quantile_bins', type=int, default=0, help='')
+    p.add_argument('--storage_dtype', type=str, default='float32', help='dtype of the loaded data, e.g. float16 or bfloat16')
+    p.add_argument('--tfr_time_records', type=int, default=0, help='TFR files are a time record store written by to_time_records')
+    p.add_argument('--tfr_interleave', type=int, default=None, help='Number of TFR files read in parallel, order not deterministic')
+    p.add_argument('--load_workers', type=int, default=None, help='Threads loading the data into RAM, default: number of CPUs, at most 8')
+    p.add_argument('--normalize_batches', type=int, default=0, help='Keep only raw data in RAM, normalize per batch')
+    p.add_argument('--prefetch_workers', type=int, default=0, help='Threads assembling batches ahead')
+    p.add_argument('--prefetch_size', type=int, default=4, help='Number of batches assembled ahead')
+    p.add_argument('--prefetch_processes', type=int, default=0, help='Prefetch workers are processes sharing the data in memory')
+    p.add_argument('--multi_worker', type=int, default=0, help='MultiWorkerMirroredStrategy over the workers in TF_CONFIG, batch_size is per replica')
+    p.add_argument('--tf_data', type=int, default=0, help='Feed in-memory data through a tf.data pipeline')
+    p.add_argument('--stream_block_size', type=int, default=None, help='Stream data from disk in blocks of this many time steps')
+    p.add_argument('--stream_buffer_blocks', type=int, default=8, help='Number of blocks shuffled together when streaming')
+    p.add_argument('--norm_cache_dir', type=str, default=None, help='Directory for cached normalization statistics')
 
     args = p.parse_args() if my_config is None else p.parse_args(args=[])
     args.var_dict = ast.literal_eval(args.var_dict)
@@ -1,6 +1,7 @@
 import pickle
 import numpy as np
 import os
+import hashlib
 import seaborn as sns
 import matplotlib.pyplot as plt
 from glob import glob
@@ -120,7 +121,8 @@ def plot_rmses(rmse, var, save_fn=None, ax=None, legend=False):
 from src.clr import LRFinder
 def find_lr(model, dg, **kwargs):
     lrf = LRFinder(dg.n_samples, dg.batch_size, verbose=0, **kwargs)
-    model.fit(dg, epochs=1, callbacks=[lrf])
+    # The generator shuffles itself, Keras must not reorder the batches (streamed blocks, prefetching)
+    model.fit(dg, epochs=1, callbacks=[lrf], shuffle=False)
     return lrf
 
 import matplotlib.ticker as ticker
@@ -159,6 +161,11 @@ def tfr_predict(model, dg, verbose=0):
         preds_tfr.append(model(X))
     return np.concatenate(preds_tfr)
 
+def files_fingerprint(fns):
+    """Hash of the names, sizes and modification times of files"""
+    stats = [(fn, os.path.getsize(fn), os.path.getmtime(fn)) for fn in sorted(fns)]
+    return hashlib.md5(repr(stats).encode()).hexdigest()
+
 def log_trans(x, e):
     return np.log(x + e) - np.log(e)
 